@@ -1,2 +1,9 @@
 from errors import *
-from manager import SchemaManager
+try:
+    import elasticsearch as _elasticsearch
+except ImportError:
+    # elasticsearch is only needed to manage schemas, routing from an exported
+    # pseudonym.table works without it.
+    _elasticsearch = None
+if _elasticsearch is not None:
+    from manager import SchemaManager
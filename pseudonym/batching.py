@@ -0,0 +1,48 @@
+import threading
+
+
+class BatchSizer(object):
+    """Tunes bulk chunk sizes from how the cluster is keeping up.
+
+    Chunks grow while bulk requests come back within ``target_latency``
+    seconds, shrink when they are slower than twice that, and halve when ES
+    rejects them. Rejections also set an exponential retry backoff.
+    """
+    def __init__(self, docs=500, size=5 * 1024 * 1024, min_docs=50, max_docs=10000,
+                 max_size=50 * 1024 * 1024, target_latency=1.0, max_scan_size=1000):
+        self._lock = threading.Lock()
+        self.docs = docs
+        self.size = size
+        self.min_docs = min_docs
+        self.max_docs = max_docs
+        self.min_size = min(size, 1024 * 1024)
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_scan_size = max_scan_size
+
+    @property
+    def limits(self):
+        return self.docs, self.size
+
+    @property
+    def scan_size(self):
+        # Scroll page size is fixed once a scroll starts, new scrolls follow
+        # the current chunk size.
+        return max(self.min_docs, min(self.docs, self.max_scan_size))
+
+    def _resize(self, factor):
+        self.docs = int(max(self.min_docs, min(self.max_docs, self.docs * factor)))
+        self.size = int(max(self.min_size, min(self.max_size, self.size * factor)))
+
+    def succeeded(self, latency, docs):
+        with self._lock:
+            if latency > 2 * self.target_latency:
+                self._resize(0.75)
+            elif latency < self.target_latency and docs >= self.docs:
+                self._resize(1.25)
+
+    def rejected(self, attempt):
+        """Backs off after a rejection, returning the seconds to wait before retrying."""
+        with self._lock:
+            self._resize(0.5)
+        return min(30, 0.5 * 2 ** attempt)
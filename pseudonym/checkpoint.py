@@ -0,0 +1,91 @@
+import datetime
+import logging
+import threading
+import time
+
+from elasticsearch.exceptions import NotFoundError
+
+logger = logging.getLogger(__name__)
+
+
+class ReindexCheckpoint(object):
+    """Progress of a reindex, persisted in the schema index so it can resume.
+
+    Each partition records whether it is done and, when the copy is sorted
+    by ``sort_field``, the last sort key written. Progress is saved at most
+    every ``interval`` seconds and whenever a partition finishes.
+    """
+    doc_type = 'reindex'
+    interval = 30
+
+    def __init__(self, client, index, source_index, target_index, partitions, sort_field=None):
+        self.client = client
+        self.index = index
+        self.source_index = source_index
+        self.target_index = target_index
+        self.partitions = partitions
+        self.sort_field = sort_field
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    @property
+    def doc_id(self):
+        return '%s:%s' % (self.source_index, self.target_index)
+
+    @classmethod
+    def create(cls, client, index, source_index, target_index, queries, sort_field=None):
+        partitions = [{'query': query, 'done': False, 'last': None} for query in queries]
+        checkpoint = cls(client, index, source_index, target_index, partitions, sort_field)
+        checkpoint.save(force=True)
+        return checkpoint
+
+    @classmethod
+    def load(cls, client, index, source_index, target_index):
+        try:
+            doc = client.get(index=index, doc_type=cls.doc_type, id='%s:%s' % (source_index, target_index))
+        except NotFoundError:
+            return None
+        source = doc['_source']
+        return cls(client, index, source_index, target_index, source['partitions'], source.get('sort_field'))
+
+    def pending(self):
+        """(partition id, query) for each unfinished partition, starting from its last key."""
+        return [(i, self._resume_query(p)) for i, p in enumerate(self.partitions) if not p['done']]
+
+    def _resume_query(self, partition):
+        query = partition['query']
+        if partition['last'] is None:
+            return query
+        # gte, not gt, re-copies docs sharing the last key, which is harmless.
+        field = self.sort_field
+        resume = {'bool': {'should': [{'range': {field: {'gte': partition['last']}}},
+                                      {'bool': {'must_not': {'exists': {'field': field}}}}]}}
+        query = dict(query or {})
+        query['query'] = {'bool': {'filter': [query.get('query', {'match_all': {}}), resume]}}
+        return query
+
+    def advance(self, partition_id, last_key):
+        with self._lock:
+            self.partitions[partition_id]['last'] = last_key
+        self.save()
+
+    def complete(self, partition_id):
+        with self._lock:
+            self.partitions[partition_id]['done'] = True
+        self.save(force=True)
+
+    @property
+    def completed(self):
+        return all(p['done'] for p in self.partitions)
+
+    def save(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._saved < self.interval:
+                return
+            body = {'source': self.source_index, 'target': self.target_index, 'sort_field': self.sort_field,
+                    'partitions': self.partitions, 'updated': datetime.datetime.utcnow().isoformat()}
+            try:
+                self.client.index(index=self.index, doc_type=self.doc_type, id=self.doc_id, body=body)
+                self._saved = time.time()
+            except Exception:
+                logger.exception("Problem saving reindex checkpoint %s" % self.doc_id)
@@ -3,34 +3,127 @@
 Usage:
   pseudonym [options] index add <alias> <index> <routing>
   pseudonym [options] index remove <index>
-  pseudonym [options] enforce
-  pseudonym [options] reindex <index> <scroll_sleep_time>
+  pseudonym [options] enforce [--dry-run] [--full]
+  pseudonym [options] reindex <index> [<scroll_sleep_time>] [--resume]
+  pseudonym [options] reindex --alias=NAME [<scroll_sleep_time>] [--resume]
   pseudonym [options] reindex_cutover <index>
+  pseudonym [options] routing_table <path>
   pseudonym (-h --help)
   pseudonym --version
 
 Options:
-  -h --help        Show this screen.
-  --version        Show version.
-  --host=HOST      Elasticsearch hostname [default: localhost].
+  -h --help              Show this screen.
+  --version              Show version.
+  --host=HOST            Elasticsearch hostname [default: localhost].
+  --workers=N            Concurrent requests made by enforce, or partitions
+                         copied at once by reindex [default: 1].
+  --dry-run              Print the calls enforce would make without making them.
+  --full                 Enforce the whole schema, not just what changed since
+                         the last enforced version.
+  --slice-field=F        Numeric or date field to partition reindexes by on
+                         clusters without sliced scroll.
+  --docs-per-second=N    Reindex write rate limit in documents.
+  --bytes-per-second=N   Reindex write rate limit in source bytes.
+  --resume               Continue a reindex from its last saved checkpoint.
+  --alias=NAME           Reindex and cut over every index of an alias.
+  --concurrency=N        Indexes reindexed at once with --alias [default: 2].
+  --per-node=N           Indexes reindexed at once with shards on any one node
+                         with --alias [default: 1].
+  --dual-write           Record the reindex as a migration so route_writes
+                         returns both indexes, and keep the source writable.
+                         Producers must write with route_writes and refresh
+                         the schema at least every --migration-delay seconds.
+  --migration-delay=S    Seconds to wait after recording a --dual-write
+                         migration before copying, for producers to see it
+                         [default: 5].
+  --online=FIELD         Keep the source writable while reindexing, catching
+                         up on documents whose FIELD, a timestamp or version,
+                         changed since. Writes are only blocked for the last
+                         changes and the cutover, which follows immediately.
+  --translog-durability=D
+                         Translog durability of reindex targets while they
+                         load, e.g. async.
+  --force-merge=N        Merge reindex targets down to N segments once loaded.
+  --sample=N             Documents per partition to compare between source and
+                         target before a cutover [default: 0].
+  --progress=S           Seconds between reindex progress lines [default: 10].
+  --transform=STAGES     module:attribute naming pseudonym.transform stages,
+                         or a function returning them, to apply to every
+                         document reindexed.
+  --transform-processes=N
+                         Processes to run in_pool transform stages in.
+
+While a reindex runs, SIGUSR1 doubles its rate limits and SIGUSR2 halves them.
 """
 
 
+import signal
+
 from docopt import docopt
 from elasticsearch.client import Elasticsearch
+from pseudonym.errors import InvalidConfigError
 from pseudonym.manager import SchemaManager
+from pseudonym.progress import ReindexProgress
+from pseudonym.transform import load_stages
+
+
+def _float(value):
+    return float(value) if value else None
+
+
+def _print_progress(stats):
+    print ('Done: ' if stats['done'] else '') + ReindexProgress.describe(stats)
 
 
 def main():
     opts = docopt(__doc__)
     manager = SchemaManager(Elasticsearch(opts['--host'], timeout=90))
+    manager.enforcer.workers = int(opts['--workers'])
+    manager.reindexer.workers = int(opts['--workers'])
+    manager.reindexer.slice_field = opts['--slice-field']
     if opts['remove']:
         manager.remove_index(opts['<index>'])
     if opts['add']:
         manager.add_index(opts['<alias>'], opts['<index>'], opts['<routing>'])
     if opts['enforce']:
-        manager.enforce()
+        if opts['--dry-run']:
+            for line in manager.plan_enforcement(opts['--full']).describe():
+                print line
+        else:
+            manager.enforce(opts['--full'])
     if opts['reindex']:
-        manager.reindex(opts['<index>'], opts['<scroll_sleep_time>'])
+        if opts['--online'] and opts['--dual-write']:
+            # Documents already in the target are left alone with dual writes, so catching up would skip updates.
+            raise InvalidConfigError("--online and --dual-write can't be combined.")
+        throttle = manager.reindexer.throttle
+        throttle.set_rate(docs_per_second=_float(opts['--docs-per-second']),
+                          bytes_per_second=_float(opts['--bytes-per-second']))
+        signal.signal(signal.SIGUSR1, lambda *_: throttle.scale(2))
+        signal.signal(signal.SIGUSR2, lambda *_: throttle.scale(0.5))
+        if opts['--translog-durability']:
+            manager.bulk_load_settings['translog.durability'] = opts['--translog-durability']
+        if opts['--transform']:
+            manager.reindexer.transforms = load_stages(opts['--transform'])
+            manager.reindexer.transform_processes = int(opts['--transform-processes'] or 0)
+        manager.reindexer.progress_interval = float(opts['--progress'])
+        manager.reindexer.callbacks.append(_print_progress)
+        force_merge = opts['--force-merge'] and int(opts['--force-merge'])
+        sleep_time = _float(opts['<scroll_sleep_time>'])
+        manager.migration_delay = float(opts['--migration-delay'])
+        manager.reindexer.changed_field = opts['--online']
+        # Before any threads are started.
+        manager.reindexer.start_transform_pool()
+        try:
+            if opts['--alias']:
+                manager.reindex_alias(opts['--alias'], int(opts['--concurrency']), int(opts['--per-node']),
+                                      opts['--resume'], int(opts['--sample']), sleep_time, force_merge,
+                                      bool(opts['--online']), opts['--dual-write'])
+                return
+            manager.reindex(opts['<index>'], sleep_time, opts['--resume'], force_merge, bool(opts['--online']),
+                            opts['--dual-write'], sample_size=int(opts['--sample']))
+        finally:
+            manager.reindexer.stop_transform_pool()
     if opts['reindex_cutover']:
-        manager.reindex_cutover(opts['<index>'])
+        manager.reindex_cutover(opts['<index>'], int(opts['--sample']))
+    if opts['routing_table']:
+        manager.export_routing_table(opts['<path>'])
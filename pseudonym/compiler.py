@@ -3,7 +3,7 @@ import logging
 from pseudonym.errors import InvalidConfigError
 from pseudonym.strategy import Strategies
 from pseudonym.filter import IndexFilter
-from pseudonym.models import Index
+from pseudonym.models import Schema
 
 logger = logging.getLogger(__name__)
 
@@ -11,30 +11,25 @@ logger = logging.getLogger(__name__)
 class SchemaCompiler(object):
     @classmethod
     def add_index(cls, existing, alias_name, index_name, routing):
-        for alias in existing['aliases']:
-            if alias['name'] == alias_name:
-                break
-        else:
+        schema = Schema.from_json(existing)
+        alias = schema.aliases.get(alias_name)
+        if alias is None:
             raise Exception("Alias %s does not exist." % alias_name)
 
-        strategy, strategy_cfg = cls._get_strategy(alias)
-
-        for index in existing['indexes']:
-            if index['name'] == index_name:
-                break
-        else:
-            index = {'name': index_name, 
-                     'alias': alias_name, 
-                     'mappings': alias.get('mappings'), 
-                     'settings': alias.get('settings')}
-            existing['indexes'].append(index)
+        if index_name not in schema.indexes:
+            schema.add_index({'name': index_name,
+                              'alias': alias_name,
+                              'mappings': alias.get('mappings'),
+                              'settings': alias.get('settings')})
 
         if routing:
-            index['routing'] = routing
+            schema.replace_index(index_name, routing=routing)
+        index = schema.indexes[index_name]
 
-        for alias in existing['aliases']:
+        for alias in schema.aliases.values():
             strategy, strategy_cfg = cls._get_strategy(alias)
-            alias['indexes'] = strategy.link_indexes(existing, alias, strategy_cfg, [index])
+            alias['indexes'] = strategy.link_indexes(schema, alias, strategy_cfg, [index])
+        existing.update(schema.to_json())
         return existing
 
     @classmethod
@@ -50,15 +45,14 @@ class SchemaCompiler(object):
 
     @classmethod
     def compile(cls, existing, config):
-        existing_aliases = {a['name']: a for a in existing.get('aliases', [])}
-        schema = {'aliases': existing['aliases'][:],
-                  'indexes': existing['indexes'][:],
-                  'templates': existing.get('templates', {})}
+        schema = Schema.from_json(existing)
+        existing_aliases = dict(schema.aliases)
 
         has_diff = False
-        existing_templates = schema['templates'].copy()
-        schema['templates'].update(config.get('templates', {}))
-        if schema['templates'] != existing_templates:
+        templates = schema.extra.setdefault('templates', {})
+        existing_templates = templates.copy()
+        templates.update(config.get('templates', {}))
+        if templates != existing_templates:
             has_diff = True
 
         index_link_args = []
@@ -76,7 +70,7 @@ class SchemaCompiler(object):
                 has_diff = True
 
             if strategy.uses_alias and not existing_alias:
-                schema['aliases'].append(compiled_alias)
+                schema.add_alias(compiled_alias)
 
             if existing_alias:
                 existing_alias.update(compiled_alias)
@@ -89,7 +83,7 @@ class SchemaCompiler(object):
                 index_cfg = index.copy()
                 index_cfg['settings'] = alias.get('settings')
                 index_cfg['mappings'] = alias.get('mappings')
-                schema['indexes'].append(index_cfg)
+                schema.add_index(index_cfg)
 
             if strategy.uses_alias:
                 index_link_args.append((compiled_alias, strategy, strategy_cfg))
@@ -110,12 +104,13 @@ class SchemaCompiler(object):
         if not has_diff:
             return None
 
-        schema['settings'] = settings
-        return schema
+        compiled = schema.to_json()
+        compiled['settings'] = settings
+        return compiled
 
     @classmethod
     def compile_settings(cls, schema, s_config):
         index_filter = IndexFilter(**s_config['filter'])
-        indexes = [Index(**i) for i in schema['indexes']]
+        indexes = [i.index for i in Schema.of(schema).indexes.values()]
         return {'indexes': [i.name for i in index_filter.filter(indexes)],
                 'settings': s_config['settings']}
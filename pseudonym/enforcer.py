@@ -1,30 +1,78 @@
 import logging
+from multiprocessing.pool import ThreadPool
 
 from elasticsearch.exceptions import RequestError, NotFoundError
+from pseudonym.errors import EnforcementError
+from pseudonym.plan import ClusterState, EnforcementPlan, alias_body
 
 
 logger = logging.getLogger(__name__)
 
 
 class SchemaEnforcer(object):
-    def __init__(self, client):
+    def __init__(self, client, workers=1, alias_chunk_size=1000, max_index_list_length=3000):
         self.client = client
+        self.workers = workers
+        self.alias_chunk_size = alias_chunk_size
+        # Index names are joined into the put_settings URL, keep it well
+        # under the HTTP line limit.
+        self.max_index_list_length = max_index_list_length
 
     def enforce(self, schema):
-        for name, template in schema['templates'].items():
-            logger.info("Creating template %s" % name)
-            self.client.indices.put_template(name=name, body=template)
-
-        for index in schema['indexes']:
-            logger.info("Creating index %s" % index['name'])
-            self.create_index(index)
+        """Applies the schema, only making the calls the cluster needs.
+
+        See ``plan`` and ``execute``.
+        """
+        self.execute(self.plan(schema))
+
+    def plan(self, schema):
+        """Diffs the schema against the cluster's current state, read in bulk."""
+        return EnforcementPlan.build(schema, ClusterState.fetch(self.client),
+                                     self.alias_chunk_size, self.max_index_list_length)
+
+    def plan_delta(self, enforced_schema, schema):
+        """Plans only what changed since ``enforced_schema`` was enforced.
+
+        No cluster state is read, the previously enforced schema stands in
+        for it.
+        """
+        return EnforcementPlan.build(schema, ClusterState.from_schema(enforced_schema),
+                                     self.alias_chunk_size, self.max_index_list_length)
+
+    def execute(self, plan):
+        """Runs a plan's actions, up to ``workers`` requests at once.
+
+        Each phase finishes before the next starts, so indexes exist before
+        aliases point at them. Failures are collected per object and raised
+        together as an EnforcementError once every phase has run.
+        """
+        failures = []
+        pool = ThreadPool(self.workers) if self.workers > 1 else None
+        try:
+            for _, actions in plan.phases:
+                self._run_all(pool, failures, actions)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        if failures:
+            raise EnforcementError(failures)
+
+    def _run_all(self, pool, failures, actions):
+        def run(action):
+            try:
+                getattr(self, action.method)(*action.args)
+            except Exception, e:
+                logger.exception("Problem enforcing %s %s" % (action.kind, action.name))
+                return action.kind, action.name, e
 
-        for alias in schema['aliases']:
-            logger.info("Creating alias %s" % alias['name'])
-            self.create_alias(alias)
+        results = pool.map(run, actions) if pool else map(run, actions)
+        failures.extend(result for result in results if result)
 
-        for setting_cfg in schema['settings']:
-            self.apply_settings(setting_cfg)
+    def put_template(self, name, template):
+        logger.info("Creating template %s" % name)
+        self.client.indices.put_template(name=name, body=template)
 
     def create_index_by_name(self, index_name):
         # By default ES will enforce whatever mapping mappings and settings are in the SI lib, IF the index name matches a template
@@ -37,6 +85,7 @@ class SchemaEnforcer(object):
                 raise
 
     def create_index(self, index):
+        logger.info("Creating index %s" % index['name'])
         body = {}
         if index.get('mappings'):
             body['mappings'] = index['mappings']
@@ -56,16 +105,20 @@ class SchemaEnforcer(object):
             return
 
         for doc_type, mapping in index['mappings'].items():
-            try:
-                self.client.indices.put_mapping(index=index['name'], doc_type=doc_type, body={doc_type: mapping})
-            except RequestError, e:
-                # MergeMappingException is ES 1x
-                if 'illegal_argument_exception' in e.error or 'MergeMappingException' in e.error:
-                    logger.exception("Error merging mappings")
-                else:
-                    raise
+            self.put_mapping(index['name'], doc_type, mapping)
+
+    def put_mapping(self, index_name, doc_type, mapping):
+        try:
+            self.client.indices.put_mapping(index=index_name, doc_type=doc_type, body={doc_type: mapping})
+        except RequestError, e:
+            # MergeMappingException is ES 1x
+            if 'illegal_argument_exception' in e.error or 'MergeMappingException' in e.error:
+                logger.exception("Error merging mappings")
+            else:
+                raise
 
     def create_alias(self, alias):
+        logger.info("Creating alias %s" % alias['name'])
         existing = set()
         try:
             existing.update(self.client.indices.get_alias(name=alias['name']))
@@ -78,18 +131,22 @@ class SchemaEnforcer(object):
             if index in existing:
                 existing.discard(index)
 
-            body = {'index': index, 'alias': alias['name']}
-            body.update({key: alias[key] for key in ['routing', 'filter'] if key in alias})
-            actions.append({'add': body})
+            actions.append({'add': alias_body(alias, index)})
         for index in existing:
             actions.append({'remove': {'index': index, 'alias': alias['name']}})
 
         if actions:
-            self.client.indices.update_aliases({'actions': actions})
+            self.update_aliases({'actions': actions})
+
+    def update_aliases(self, body):
+        self.client.indices.update_aliases(body)
 
     def apply_settings(self, setting_cfg):
-        print 'putting settings to %s, body=%s' % (','.join(setting_cfg['indexes']), setting_cfg['settings'])
-        self.client.indices.put_settings(index=','.join(setting_cfg['indexes']), body=setting_cfg['settings'])
+        self.put_settings(setting_cfg['indexes'], setting_cfg['settings'])
+
+    def put_settings(self, indexes, settings):
+        logger.info('putting settings to %s, body=%s' % (','.join(indexes), settings))
+        self.client.indices.put_settings(index=','.join(indexes), body=settings)
 
     def index_exists(self, index):
         return self.client.indices.exists(index=index)
@@ -3,3 +3,12 @@ class InvalidConfigError(Exception):
 
 class RoutingException(Exception):
     pass
+
+class ReindexStopped(Exception):
+    pass
+
+class EnforcementError(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        super(EnforcementError, self).__init__("%s schema objects failed to enforce: %s" % (
+            len(failures), ', '.join('%s %s' % (kind, name) for kind, name, _ in failures)))
@@ -1,57 +1,136 @@
 import logging
 import json
+import threading
+import time
 
+from elasticsearch.exceptions import NotFoundError
 from pseudonym.compiler import SchemaCompiler
 from pseudonym.enforcer import SchemaEnforcer
-from pseudonym.errors import RoutingException
-from pseudonym.strategy import Strategies
+from pseudonym.models import Schema
+from pseudonym.plan import flatten_settings
 from pseudonym.reindexer import Reindexer
+from pseudonym.scheduler import ReindexScheduler
+from pseudonym.snapshot import SchemaSnapshot
+from pseudonym.strategy import write_indexes, write_groups
+from pseudonym.table import RoutingTable
+from pseudonym.watcher import SchemaWatcher
 
 logger = logging.getLogger(__name__)
 
+# Seconds between schema refreshes of a watching manager, see ``SchemaManager.watch``.
+WATCH_INTERVAL = 5
+
 
 class SchemaManager(object):
-    def __init__(self, client, schema_index='pseudonym'):
+    def __init__(self, client, schema_index='pseudonym', snapshot_path=None):
         self.client = client
         self.schema_index = schema_index
-        self._schema = None
-        self._strategies = None
-        self._routers = {}
+        self.snapshot_path = snapshot_path
+        self._snapshot = None
+        self._watcher = None
+        # Held while reading, changing and applying the schema, so concurrent
+        # reindexes in one process don't conflict.
+        self._lock = threading.RLock()
         self.enforcer = SchemaEnforcer(self.client)
-        self.reindexer = Reindexer(self.client)
+        self.reindexer = Reindexer(self.client, checkpoint_index=self.schema_index)
+        # Applied to reindex targets while they load, then restored.
+        self.bulk_load_settings = {'refresh_interval': '-1', 'number_of_replicas': 0}
+        # Seconds for producers to pick up a new migration before a dual write
+        # copy starts. Producers must write with route_writes and refresh the
+        # schema at least this often, or their writes can miss the target.
+        self.migration_delay = WATCH_INTERVAL
 
     schema_type = 'schema'
     CFG_FIELDS = ['routing', 'alias']
+    # What bulk load settings go back to when the index had no value of its own.
+    DEFAULT_SETTINGS = {'index.refresh_interval': '1s', 'index.translog.durability': 'request'}
 
     def get_current_schema(self, force=False):
-        if not self._schema or force:
-            self._strategies = None
-            schema = self.client.get(index=self.schema_index, id='master')
-            source = schema.pop('_source')
-            schema_doc = source.get('schema', source)
-            if isinstance(schema_doc, basestring):
-                schema_doc = json.loads(schema_doc)
-            self._schema = schema, schema_doc
-        return self._schema
+        if force:
+            snapshot = self._publish(*self._fetch_schema())
+        else:
+            snapshot = self.snapshot
+        return snapshot.meta, snapshot.schema
 
-    def get_router(self, alias_name):
-        if alias_name not in self._routers:
-            _, schema = self.get_current_schema()
-            for alias in schema['aliases']:
-                if alias['name'] == alias_name:
-                    break
-            else:
-                raise RoutingException("%s is not in the schema." % alias_name)
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if not snapshot:
+            snapshot = self._load_local_snapshot() or self._publish(*self._fetch_schema())
+        return snapshot
+
+    def _load_local_snapshot(self):
+        # Route from the local file right away and revalidate it against ES in
+        # the background.
+        if not self.snapshot_path:
+            return None
+        snapshot = SchemaSnapshot.load(self.snapshot_path)
+        if not snapshot:
+            return None
+        self._snapshot = snapshot
+        thread = threading.Thread(target=self._revalidate, name='pseudonym-snapshot-revalidate')
+        thread.daemon = True
+        thread.start()
+        return snapshot
+
+    def _revalidate(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Problem revalidating schema snapshot %s" % self.snapshot_path)
+
+    def _fetch_schema(self, doc_id='master'):
+        schema = self.client.get(index=self.schema_index, id=doc_id)
+        source = schema.pop('_source')
+        schema_doc = source.get('schema', source)
+        if isinstance(schema_doc, basestring):
+            schema_doc = json.loads(schema_doc)
+        return schema, schema_doc
+
+    def _publish(self, meta, schema):
+        # Everything is compiled before the single reference swap, readers see
+        # either the previous snapshot or this one, never a mix.
+        snapshot = SchemaSnapshot(meta, schema, self._snapshot)
+        self._snapshot = snapshot
+        if self.snapshot_path:
+            try:
+                snapshot.dump(self.snapshot_path)
+            except (IOError, OSError, ValueError):
+                logger.exception("Problem writing schema snapshot %s" % self.snapshot_path)
+        return snapshot
+
+    def refresh(self):
+        """Reloads the schema only if the master doc's version has moved.
+
+        New routers are compiled before anything is swapped in, so routing
+        keeps using the previous routers until the reload is complete.
+        Returns whether a new version was loaded.
+        """
+        meta = self.client.get(index=self.schema_index, id='master', _source=False)
+        snapshot = self._snapshot
+        if snapshot and snapshot.version == meta['_version']:
+            return False
+        self._publish(*self._fetch_schema())
+        return True
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """Starts a background thread that refreshes the schema every ``interval`` seconds."""
+        if not self._watcher:
+            self._watcher = SchemaWatcher(self, interval)
+            self._watcher.start()
+        return self._watcher
 
-            self._routers[alias_name] = self.strategies[alias_name].get_router(schema, alias)
-        return self._routers[alias_name]
+    def stop_watching(self):
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+
+    def get_router(self, alias_name):
+        return self.snapshot.get_router(alias_name)
 
     @property
     def strategies(self):
-        _, schema = self.get_current_schema()
-        if not self._strategies:
-            self._strategies = {a['name']: Strategies[a['strategy'].keys()[0]].instance() for a in schema['aliases']}
-        return self._strategies
+        return self.snapshot.strategies
 
     def update(self, config):
         if not self.enforcer.index_exists(index=self.schema_index):
@@ -60,7 +139,7 @@ class SchemaManager(object):
             self.client.index(index=self.schema_index, id='master', doc_type=self.schema_type,
                               body=schema, version=0, version_type='external')
 
-        meta, existing = self.get_current_schema(True)
+        meta, existing = self._fetch_schema()
         schema = SchemaCompiler.compile(existing, config)
         if schema is None:
             return
@@ -72,89 +151,231 @@ class SchemaManager(object):
                           id='master', body=schema_doc, refresh=True,
                           version=meta['_version'] + 1, version_type='external')
         self.client.create(index=self.schema_index, doc_type=self.schema_type, id=meta['_version'] + 1, body=schema_doc)
-        self._routers = {}
+        self._publish(dict(meta, _version=meta['_version'] + 1), schema)
 
     def add_index(self, alias_name, index_name, routing=None):
-        meta, schema = self.get_current_schema(True)
-        SchemaCompiler.add_index(schema, alias_name, index_name, routing)
-        self.apply(meta, schema)
+        with self._lock:
+            meta, schema = self._fetch_schema()
+            SchemaCompiler.add_index(schema, alias_name, index_name, routing)
+            self.apply(meta, schema)
 
     def remove_index(self, index_name):
-        meta, schema = self.get_current_schema(True)
-        for alias in schema['aliases']:
-            if index_name in alias['indexes']:
-                alias['indexes'].remove(index_name)
-        for settings in schema['settings']:
-            if index_name in settings['indexes']:
-                settings['indexes'].remove(index_name)
-        for index_cfg in schema['indexes'][:]:
-            if index_cfg['name'] == index_name:
-                schema['indexes'].remove(index_cfg)
+        with self._lock:
+            meta, schema = self._fetch_schema()
+            for alias in schema['aliases']:
+                if index_name in alias['indexes']:
+                    alias['indexes'].remove(index_name)
+            for settings in schema['settings']:
+                if index_name in settings['indexes']:
+                    settings['indexes'].remove(index_name)
+            model = Schema.from_json(schema)
+            if index_name in model.indexes:
+                model.remove_index(index_name)
+            schema['indexes'] = model.to_json()['indexes']
+            # Writes mustn't keep going to it, where they would recreate it.
+            migrations = schema.get('migrations', {})
+            for source, target in migrations.items():
+                if index_name in (source, target):
+                    del migrations[source]
+            # Nor should enforce keep its load settings, for an index that's gone.
+            schema.get('bulk_load', {}).pop(index_name, None)
 
-        self.apply(meta, schema)
+            self.apply(meta, schema)
 
-    def enforce(self):
+    def enforce(self, full=False):
         try:
-            self.enforcer.enforce(self.get_current_schema(True)[1])
+            meta, plan = self._plan_enforcement(full)
+            self.enforcer.execute(plan)
+            self.client.index(index=self.schema_index, doc_type=self.schema_type, id='enforced',
+                              body={'version': meta['_version']}, refresh=True)
         except Exception, e:
-            logger.exception("Problem during schema enforcement: %s" % e.error)
+            logger.exception("Problem during schema enforcement: %s" % e)
+
+    def plan_enforcement(self, full=False):
+        return self._plan_enforcement(full)[1]
+
+    def _plan_enforcement(self, full):
+        # Unless asked for a full run, only enforce what changed since the
+        # last version that was enforced successfully.
+        meta, schema = self.get_current_schema(True)
+        enforced = None if full else self._get_enforced_schema()
+        if enforced is None:
+            return meta, self.enforcer.plan(schema)
+        return meta, self.enforcer.plan_delta(enforced, schema)
+
+    def _get_enforced_schema(self):
+        try:
+            enforced = self.client.get(index=self.schema_index, doc_type=self.schema_type, id='enforced')
+            return self._fetch_schema(str(enforced['_source']['version']))[1]
+        except NotFoundError:
+            return None
 
 
     def route(self, alias, routing):
-        return self.get_router(alias).route(routing)['name']
+        return self.snapshot.get_router(alias).route(routing)['name']
+
+    def route_many(self, alias, items, key=None):
+        """Routes a batch at once, returning {index_name: [item, ...]}.
+
+        ``key`` extracts the routing value from each item (a document for
+        instance), by default the items are the routing values themselves.
+        """
+        return self.snapshot.get_router(alias).route_many(items, key)
+
+    def route_writes(self, alias, routing):
+        """Like ``route``, but a list with the target too while the index is migrating."""
+        return write_indexes(self.route(alias, routing), self.snapshot.migrations)
+
+    def route_many_writes(self, alias, items, key=None):
+        """Like ``route_many``, with items also grouped under targets of migrating indexes."""
+        return write_groups(self.route_many(alias, items, key), self.snapshot.migrations)
 
     def reload(self):
         self.get_current_schema(True)
 
+    def export_routing_table(self, path):
+        """Writes the current routers to a routing table, see ``pseudonym.table``."""
+        self.reload()
+        RoutingTable.from_snapshot(self.snapshot).dump(path)
+
     '''
     1. creates new index during initial reindex call
     2. reindexes all docs to new index
     3. After reindex complete call reindex_cutover to move aliases to new index
     '''
-    def reindex(self, source_index, sleep_time):
+    def reindex(self, source_index, sleep_time=None, resume=False, force_merge=None, online=False,
+                dual_write=False, reindexer=None, sample_size=0):
+        """Copies source_index to its next target, returning whether it all made it.
+
+        Online, that includes the cutover, verified with ``sample_size``
+        documents per partition. ``reindexer`` stands in for the manager's
+        own, for concurrent reindexes.
+        """
+        reindexer = reindexer or self.reindexer
         target_index = self._get_target_index(source_index)
         if not self.enforcer.index_exists(index=target_index):
             self.enforcer.create_index_by_name(target_index)
-            meta, schema = self.get_current_schema(True)
-            for index_cfg in schema['indexes']:
-                if index_cfg['name'] == source_index:
-                    target_cfg = dict(index_cfg)
-                    break
-            target_cfg['name'] = target_index
-            schema['indexes'].append(target_cfg)
+            with self._lock:
+                meta, schema = self._fetch_schema()
+                model = Schema.from_json(schema)
+                model.add_index(model.indexes[source_index].replace(name=target_index))
+                self.apply(meta, model.to_json())
+        if dual_write and self.start_migration(source_index, target_index):
+            # Until producers see the migration their writes only go to the
+            # source, after the point in time the copy scrolls from.
+            time.sleep(self.migration_delay)
+        self.start_bulk_load(target_index)
+        try:
+            done = reindexer.do_reindex(source_index, target_index, sleep_time, resume, online, dual_write)
+        finally:
+            self.finish_bulk_load(target_index)
+        if done and online:
+            # The source is write blocked until its aliases have moved.
+            try:
+                done = self.reindex_cutover(source_index, sample_size)
+            finally:
+                reindexer.set_write_block(source_index, False)
+        if done and force_merge:
+            self.client.indices.forcemerge(index=target_index, max_num_segments=force_merge)
+        return done
+
+    def reindex_alias(self, alias_name, concurrency=2, per_node=1, resume=False, sample_size=0, sleep_time=None,
+                      force_merge=None, online=False, dual_write=False):
+        """Reindexes and cuts over every index of an alias, see ``ReindexScheduler``."""
+        return ReindexScheduler(self, alias_name, concurrency, per_node, sample_size, sleep_time, force_merge,
+                                online, dual_write).run(resume)
+
+    def start_migration(self, source_index, target_index):
+        """Has ``route_writes`` send writes for source_index to target_index too, until cutover.
+
+        Producers only see the migration once they refresh the schema, see
+        ``watch``. Returns False if it was already recorded.
+        """
+        with self._lock:
+            meta, schema = self._fetch_schema()
+            migrations = schema.setdefault('migrations', {})
+            if migrations.get(source_index) == target_index:
+                return False
+            migrations[source_index] = target_index
             self.apply(meta, schema)
-        self.reindexer.do_reindex(source_index, target_index, sleep_time)
+            return True
 
-    def reindex_cutover(self, source_index):
-        _, schema = self.get_current_schema(True)
-        # add new index to aliases, remove old index from aliases
-        routing = None
-        source_cfg = None
-        for index_cfg in schema['indexes']:
-            if index_cfg['name'] == source_index:
-                routing = index_cfg.get('routing')
-                source_cfg = index_cfg
-                break
+    def finish_migration(self, source_index):
+        with self._lock:
+            meta, schema = self._fetch_schema()
+            if schema.get('migrations', {}).pop(source_index, None):
+                self.apply(meta, schema)
+
+    def start_bulk_load(self, index_name):
+        """Puts ``bulk_load_settings`` on an index, noting them in the schema so enforce keeps them."""
+        settings = flatten_settings(self.bulk_load_settings, normalize=False)
+        current = {}
+        for body in self.client.indices.get_settings(index=index_name).values():
+            current.update(flatten_settings(body.get('settings')))
+        with self._lock:
+            meta, schema = self._fetch_schema()
+            restore = schema.get('bulk_load', {}).get(index_name, {}).get('restore')
+            if restore is None:
+                restore = {k: current.get(k, self.DEFAULT_SETTINGS.get(k)) for k in settings}
+            schema.setdefault('bulk_load', {})[index_name] = {'settings': settings, 'restore': restore}
+            self.apply(meta, schema)
+            self.enforcer.put_settings([index_name], settings)
 
+    def finish_bulk_load(self, index_name):
+        """Puts back what an index had before ``start_bulk_load``, or what the schema gives it."""
+        with self._lock:
+            meta, schema = self._fetch_schema()
+            bulk_load = schema.get('bulk_load', {}).pop(index_name, None)
+            if bulk_load is None:
+                return
+            settings = {k: v for k, v in bulk_load['restore'].items() if v is not None}
+            for setting_cfg in schema.get('settings', []):
+                if index_name in setting_cfg['indexes']:
+                    desired = flatten_settings(setting_cfg['settings'], normalize=False)
+                    settings.update((k, v) for k, v in desired.items() if k in bulk_load['settings'])
+            if settings:
+                self.enforcer.put_settings([index_name], settings)
+            self.apply(meta, schema)
+
+    def reindex_cutover(self, source_index, sample_size=0):
         target_index = self._get_target_index(source_index)
-        for alias in schema['aliases']:
-            if source_index in alias['indexes']:
-                self.add_index(alias['name'], target_index, routing=routing)
-                self.remove_index(source_index)
+        if not self.verify_data(source_index, target_index, sample_size):
+            logger.error("Refusing to cut %s over to %s, the data did not verify" % (source_index, target_index))
+            return False
+        with self._lock:
+            _, schema = self.get_current_schema(True)
+            # add new index to aliases, remove old index from aliases
+            source_cfg = Schema.from_json(schema).indexes.get(source_index)
+            routing = source_cfg.get('routing') if source_cfg else None
 
-        if not self.verify_cutover(source_cfg, target_index):
-            # If we fail verification then we need to see why and take manual steps to fix
-            return
-        self.enforce()
+            for alias in schema['aliases']:
+                if source_index in alias['indexes']:
+                    self.add_index(alias['name'], target_index, routing=routing)
+                    self.remove_index(source_index)
+
+            if not self.verify_cutover(source_cfg, target_index):
+                # If we fail verification then we need to see why and take manual steps to fix
+                if source_index in self._fetch_schema()[1].get('migrations', {}):
+                    logger.error("Writes to %s still go to %s as well, run finish_migration for %s once the cutover "
+                                 "is fixed" % (source_index, target_index, source_index))
+                return False
+            self.enforce()
+            self.finish_migration(source_index)
+        return True
+
+    def verify_data(self, source_index, target_index, sample_size=0):
+        ok = True
+        for report in self.reindexer.verify(source_index, target_index, sample_size):
+            if not report['ok']:
+                logger.error("Partition %(partition)s of %(source_index)s has %(source)s documents, %(target_index)s "
+                             "has %(target)s, sample matched: %(sample)s" %
+                             dict(report, source_index=source_index, target_index=target_index))
+                ok = False
+        return ok
 
     def verify_cutover(self, source_index_cfg, target_index_name):
-        target_cfg = None
         _, schema = self.get_current_schema(True)
-
-        for index_cfg in schema['indexes']:
-            if index_cfg['name'] == target_index_name:
-                target_cfg = index_cfg
-                break
+        target_cfg = Schema.from_json(schema).indexes.get(target_index_name)
 
         for field in self.CFG_FIELDS:
             if source_index_cfg.get(field) != target_cfg.get(field):
@@ -13,3 +13,131 @@ def namedtuple_with_defaults(typename, field_names, default_values=tuple()):
     return T
 
 Index = namedtuple_with_defaults('Index', ('name', 'alias', 'routing', 'mappings', 'settings'))
+
+
+class IndexRecord(namedtuple_with_defaults('IndexRecord', Index._fields + ('absent', 'extra'))):
+    """An index config as a compact tuple, read like the dict it came from.
+
+    ``record['routing']`` raises KeyError if the dict had no routing, and
+    ``to_dict`` gives the same dict back. ``absent`` names the Index fields
+    the dict didn't have, ``extra`` holds any keys Index doesn't know.
+    """
+    __slots__ = ()
+    _absent_sets = {}
+
+    @classmethod
+    def from_dict(cls, index):
+        absent = frozenset(f for f in Index._fields if f not in index)
+        extra = {k: v for k, v in index.items() if k not in Index._fields} or None
+        return cls(*[index.get(f) for f in Index._fields], absent=cls._intern(absent), extra=extra)
+
+    @classmethod
+    def _intern(cls, absent):
+        # Most records lack the same few fields, so they share one set.
+        return cls._absent_sets.setdefault(absent, absent)
+
+    def __getitem__(self, key):
+        if not isinstance(key, basestring):
+            return tuple.__getitem__(self, key)
+        if key in Index._fields and key not in self.absent:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return (key in Index._fields and key not in self.absent) or bool(self.extra and key in self.extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def replace(self, **fields):
+        return self._replace(absent=self._intern(self.absent - set(fields)), **fields)
+
+    @property
+    def index(self):
+        return Index(*tuple.__getitem__(self, slice(0, len(Index._fields))))
+
+    def to_dict(self):
+        index = {f: getattr(self, f) for f in Index._fields if f not in self.absent}
+        if self.extra:
+            index.update(self.extra)
+        return index
+
+
+class Schema(object):
+    """A compiled schema with its indexes and aliases keyed by name.
+
+    ``from_json`` and ``to_json`` convert from and to the dict kept in the
+    schema index without loss. Indexes are IndexRecords, aliases stay the
+    dicts they were given as.
+    """
+    def __init__(self, indexes=(), aliases=(), extra=None):
+        self.indexes = collections.OrderedDict()
+        self.aliases = collections.OrderedDict()
+        self.extra = extra or {}
+        self._by_alias = {}
+        self._order = {}
+        self._next = 0
+        for index in indexes:
+            self.add_index(index)
+        for alias in aliases:
+            self.add_alias(alias)
+
+    @classmethod
+    def from_json(cls, schema):
+        extra = {k: v for k, v in schema.items() if k not in ('indexes', 'aliases')}
+        return cls(schema.get('indexes', ()), schema.get('aliases', ()), extra)
+
+    @classmethod
+    def of(cls, schema):
+        return schema if isinstance(schema, cls) else cls.from_json(schema)
+
+    def to_json(self):
+        schema = dict(self.extra)
+        schema['indexes'] = [index.to_dict() for index in self.indexes.values()]
+        schema['aliases'] = self.aliases.values()
+        return schema
+
+    def add_index(self, index):
+        if not isinstance(index, IndexRecord):
+            index = IndexRecord.from_dict(index)
+        if index.name in self.indexes:
+            self.remove_index(index.name)
+        self.indexes[index.name] = index
+        self._by_alias.setdefault(index.alias, []).append(index.name)
+        self._order[index.name] = self._next
+        self._next += 1
+        return index
+
+    def replace_index(self, name, **fields):
+        """Changes fields of an index, keeping its place."""
+        index = self.indexes[name].replace(**fields)
+        self.indexes[name] = index
+        if 'alias' in fields:
+            self._by_alias = {}
+            for other in self.indexes.values():
+                self._by_alias.setdefault(other.alias, []).append(other.name)
+        return index
+
+    def remove_index(self, name):
+        index = self.indexes.pop(name)
+        self._by_alias[index.alias].remove(name)
+        del self._order[name]
+        return index
+
+    def add_alias(self, alias):
+        self.aliases[alias['name']] = alias
+        return alias
+
+    def in_order(self, names):
+        """The indexes with these names, in schema order, skipping unknown ones."""
+        return sorted((self.indexes[name] for name in set(names) if name in self.indexes),
+                      key=lambda index: self._order[index.name])
+
+    def indexes_of(self, alias_names):
+        """The indexes created for any of these aliases, in schema order."""
+        return self.in_order(name for alias in set(alias_names) for name in self._by_alias.get(alias, ()))
@@ -0,0 +1,214 @@
+import json
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+Action = namedtuple('Action', ('kind', 'name', 'method', 'args'))
+
+PHASES = ('templates', 'indexes', 'mappings', 'aliases', 'settings')
+
+
+def _norm(value):
+    # ES hands settings back as strings, and booleans as 'true'/'false'.
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, tuple)):
+        return [_norm(v) for v in value]
+    if value is None:
+        return None
+    return unicode(value)
+
+
+def flatten(doc, prefix='', normalize=True):
+    flat = {}
+    for key, value in (doc or {}).items():
+        path = prefix + key
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, path + '.', normalize))
+        else:
+            flat[path] = _norm(value) if normalize else value
+    return flat
+
+
+def flatten_settings(settings, normalize=True):
+    return {k if k.startswith('index.') else 'index.' + k: v for k, v in flatten(settings, normalize=normalize).items()}
+
+
+def chunk_index_names(indexes, max_length):
+    """Splits index names into lists whose comma-joined length fits max_length."""
+    chunk, length = [], 0
+    for index in indexes:
+        if chunk and length + len(index) + 1 > max_length:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(index)
+        length += len(index) + 1
+    if chunk:
+        yield chunk
+
+
+def contains(existing, desired):
+    return all(existing.get(key) == value for key, value in desired.items())
+
+
+def alias_body(alias, index):
+    body = {'index': index, 'alias': alias['name']}
+    body.update({key: alias[key] for key in ['routing', 'filter'] if key in alias})
+    return body
+
+
+def _alias_matches(alias, props):
+    routing = alias.get('routing')
+    return (props.get('index_routing') == routing and
+            props.get('search_routing') == routing and
+            props.get('filter') == alias.get('filter'))
+
+
+def _template_matches(existing, desired):
+    if existing is None:
+        return False
+    return (existing.get('template') == desired.get('template') and
+            int(existing.get('order') or 0) == int(desired.get('order') or 0) and
+            flatten(existing.get('mappings')) == flatten(desired.get('mappings')) and
+            flatten_settings(existing.get('settings')) == flatten_settings(desired.get('settings')) and
+            set(existing.get('aliases') or {}) == set(desired.get('aliases') or {}))
+
+
+class ClusterState(object):
+    """Templates, mappings, aliases and settings of a cluster, read in bulk."""
+    def __init__(self, templates, mappings, aliases, settings):
+        self.templates = templates
+        self.mappings = mappings
+        self.aliases = aliases
+        self.settings = settings
+
+    @classmethod
+    def fetch(cls, client):
+        templates = client.indices.get_template()
+        mappings = {index: body.get('mappings', {}) for index, body in client.indices.get_mapping().items()}
+        aliases = {}
+        for index, body in client.indices.get_alias().items():
+            for name, props in body.get('aliases', {}).items():
+                aliases.setdefault(name, {})[index] = props
+        settings = {index: flatten_settings(body.get('settings'))
+                    for index, body in client.indices.get_settings().items()}
+        return cls(templates, mappings, aliases, settings)
+
+    @classmethod
+    def from_schema(cls, schema):
+        """The state a cluster is in once ``schema`` has been enforced on it."""
+        mappings = {i['name']: i.get('mappings') or {} for i in schema['indexes']}
+        aliases = {}
+        for alias in schema['aliases']:
+            props = {}
+            if alias.get('routing') is not None:
+                props['index_routing'] = props['search_routing'] = alias['routing']
+            if alias.get('filter') is not None:
+                props['filter'] = alias['filter']
+            aliases[alias['name']] = {index: props for index in alias['indexes']}
+        settings = {i['name']: {} for i in schema['indexes']}
+        for setting_cfg in schema.get('settings', []):
+            for index in setting_cfg['indexes']:
+                settings.setdefault(index, {}).update(flatten_settings(setting_cfg['settings']))
+        for index, bulk_load in schema.get('bulk_load', {}).items():
+            settings.setdefault(index, {}).update(flatten_settings(bulk_load['settings']))
+        return cls(dict(schema.get('templates', {})), mappings, aliases, settings)
+
+    def index_exists(self, index):
+        return index in self.settings
+
+
+class EnforcementPlan(object):
+    """The calls needed to bring a cluster in line with a compiled schema.
+
+    Actions are grouped in phases that must run in order, see ``PHASES``.
+    """
+    def __init__(self):
+        self.phases = [(phase, []) for phase in PHASES]
+
+    def add(self, phase, action):
+        dict(self.phases)[phase].append(action)
+
+    @property
+    def actions(self):
+        return [action for _, actions in self.phases for action in actions]
+
+    def __len__(self):
+        return len(self.actions)
+
+    def describe(self):
+        return ['%s %s: %s %s' % (action.kind, action.name, action.method, json.dumps(action.args[-1], sort_keys=True))
+                for action in self.actions]
+
+    @staticmethod
+    def _alias_actions(alias, existing):
+        existing = dict(existing)
+        actions = []
+        for index in alias['indexes']:
+            props = existing.pop(index, None)
+            if props is None or not _alias_matches(alias, props):
+                actions.append({'add': alias_body(alias, index)})
+        for index in existing:
+            actions.append({'remove': {'index': index, 'alias': alias['name']}})
+        return actions
+
+    @classmethod
+    def build(cls, schema, state, alias_chunk_size=1000, max_index_list_length=3000):
+        plan = cls()
+
+        for name, template in schema['templates'].items():
+            if not _template_matches(state.templates.get(name), template):
+                plan.add('templates', Action('template', name, 'put_template', (name, template)))
+
+        for index in schema['indexes']:
+            if not state.index_exists(index['name']):
+                plan.add('indexes', Action('index', index['name'], 'create_index', (index,)))
+                continue
+            existing = state.mappings.get(index['name'], {})
+            for doc_type, mapping in (index.get('mappings') or {}).items():
+                if not contains(flatten(existing.get(doc_type)), flatten(mapping)):
+                    plan.add('mappings', Action('mapping', '%s/%s' % (index['name'], doc_type), 'put_mapping',
+                                                (index['name'], doc_type, mapping)))
+
+        # Alias changes go out in as few update_aliases calls as possible so
+        # they are applied atomically. Large action lists are chunked, but an
+        # alias's own actions are never split across chunks.
+        names, actions = [], []
+        for alias in schema['aliases']:
+            alias_actions = cls._alias_actions(alias, state.aliases.get(alias['name'], {}))
+            if not alias_actions:
+                continue
+            if actions and len(actions) + len(alias_actions) > alias_chunk_size:
+                plan.add('aliases', Action('alias', ','.join(names), 'update_aliases', ({'actions': actions},)))
+                names, actions = [], []
+            names.append(alias['name'])
+            actions.extend(alias_actions)
+        if actions:
+            plan.add('aliases', Action('alias', ','.join(names), 'update_aliases', ({'actions': actions},)))
+
+        # Work out what each index still needs, with later setting groups
+        # overriding earlier ones, then send one request per distinct body.
+        # Every index is in at most one request, so they can run concurrently.
+        desired = {}
+        for setting_cfg in schema['settings']:
+            settings = flatten_settings(setting_cfg['settings'], normalize=False)
+            for index in setting_cfg['indexes']:
+                desired.setdefault(index, {}).update(settings)
+        # Indexes being bulk loaded keep their load settings until it's done.
+        for index, bulk_load in schema.get('bulk_load', {}).items():
+            desired.setdefault(index, {}).update(bulk_load['settings'])
+
+        bodies = {}
+        for index in sorted(desired):
+            existing = state.settings.get(index, {})
+            needed = {k: v for k, v in desired[index].items() if existing.get(k) != _norm(v)}
+            if needed:
+                key = json.dumps(needed, sort_keys=True)
+                bodies.setdefault(key, (needed, []))[1].append(index)
+
+        for key in sorted(bodies):
+            settings, indexes = bodies[key]
+            for chunk in chunk_index_names(indexes, max_index_list_length):
+                plan.add('settings', Action('settings', ','.join(chunk), 'put_settings', (chunk, settings)))
+        return plan
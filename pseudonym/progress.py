@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import deque
+
+
+def percentile(values, pct):
+    """The nearest rank percentile of sorted ``values``, None when empty."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class ReindexProgress(object):
+    """Counters for a running reindex, safe to update from every partition.
+
+    Bulk latencies are kept for the last ``window`` requests.
+    """
+    def __init__(self, total=None, window=1000):
+        self._lock = threading.Lock()
+        self.total = total
+        self.started = time.time()
+        self.finished = None
+        self.scanned = 0
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        self.bytes = 0
+        self.requests = 0
+        self._latencies = deque(maxlen=window)
+
+    def add_scanned(self, docs=1):
+        with self._lock:
+            self.scanned += docs
+
+    def add_bulk(self, latency, written, failed, size):
+        with self._lock:
+            self.requests += 1
+            self.written += written
+            self.failed += failed
+            self.bytes += size
+            self._latencies.append(latency)
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def update(self, **counts):
+        """Sets counters outright, for progress reported by the server."""
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, value)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def stats(self):
+        with self._lock:
+            elapsed = (self.finished or time.time()) - self.started
+            latencies = sorted(self._latencies)
+            stats = {'total': self.total, 'scanned': self.scanned, 'written': self.written, 'failed': self.failed,
+                     'retries': self.retries, 'bytes': self.bytes, 'requests': self.requests, 'elapsed': elapsed,
+                     'done': self.finished is not None}
+        done = stats['written'] + stats['failed']
+        stats['docs_per_second'] = done / elapsed if elapsed else 0.0
+        stats['latency'] = {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+                            'p99': percentile(latencies, 99)}
+        stats['eta'] = None
+        if self.total is not None and stats['docs_per_second']:
+            stats['eta'] = max(0, self.total - done) / stats['docs_per_second']
+        return stats
+
+    @staticmethod
+    def describe(stats):
+        line = '%(written)s/%(total)s written, %(scanned)s scanned, %(failed)s failed, %(retries)s retries, ' \
+               '%(bytes)s bytes, %(docs_per_second).1f docs/s' % stats
+        if stats['latency']['p50'] is not None:
+            line += ', bulk latency p50 %.3fs p90 %.3fs p99 %.3fs' % (
+                stats['latency']['p50'], stats['latency']['p90'], stats['latency']['p99'])
+        if stats['done']:
+            line += ', took %.1fs' % stats['elapsed']
+        elif stats['eta'] is not None:
+            line += ', eta %.0fs' % stats['eta']
+        return line
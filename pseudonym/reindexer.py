@@ -1,46 +1,572 @@
-import time
 import datetime
+import hashlib
+import json
 import logging
+import math
+import threading
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from elasticsearch.helpers import scan, streaming_bulk, bulk, reindex
+from elasticsearch.exceptions import NotFoundError, TransportError
+from elasticsearch.helpers import scan, expand_action
+from pseudonym.batching import BatchSizer
+from pseudonym.checkpoint import ReindexCheckpoint
+from pseudonym.errors import InvalidConfigError, ReindexStopped
+from pseudonym.progress import ReindexProgress
+from pseudonym.throttle import Throttle
+from pseudonym.transform import pipeline
 
 logger = logging.getLogger(__name__)
 
+
+def checksum(docs):
+    """A digest of (type, id, source) triples, independent of their order."""
+    digest = hashlib.md5()
+    for line in sorted(json.dumps(doc, sort_keys=True) for doc in docs):
+        digest.update(line)
+    return digest.hexdigest()
+
+
 class Reindexer(object):
 
-    def __init__(self, client):
+    def __init__(self, client, workers=1, slice_field=None, checkpoint_index=None):
         self.client = client
+        # Where progress checkpoints are kept, no checkpoints without one.
+        self.checkpoint_index = checkpoint_index
+        # With more than one worker the source is split into that many
+        # partitions, copied concurrently. Sliced scroll is used where the
+        # server has it, otherwise ranges of slice_field.
+        self.workers = workers
+        self.slice_field = slice_field
+        # Shared by every partition and adjustable while a reindex runs.
+        self.throttle = Throttle()
+        self.sizer = BatchSizer()
+        self.max_retries = 5
+        # Use the server's _reindex where it has one, None detects it.
+        self.native = None
+        self.poll_interval = 5
+        # Called with ReindexProgress.stats() every progress_interval seconds
+        # while a reindex runs, and once more when it's done.
+        self.callbacks = []
+        self.progress_interval = 10
+        # Stages from pseudonym.transform applied to every document copied.
+        # Those marked in_pool run in this many processes, if any, see
+        # start_transform_pool.
+        self.transforms = []
+        self.transform_processes = 0
+        self._process_pool = None
+        # Online reindexes copy again whatever this field says changed since
+        # the last pass, at most catch_up_passes times or until no more than
+        # catch_up_threshold documents are left for the write blocked pass.
+        self.changed_field = None
+        self.catch_up_passes = 3
+        self.catch_up_threshold = 1000
+        self.progress = ReindexProgress()
+        self._reported = 0
+        self._report_lock = threading.Lock()
+        self._op_type = 'index'
+        self._version = None
+        self._stop = threading.Event()
+        # A server side _reindex task that may still be copying.
+        self._task_id = None
+
+    def clone(self):
+        """A reindexer with the same configuration, sharing the throttle, for a concurrent reindex."""
+        reindexer = Reindexer(self.client, self.workers, self.slice_field, self.checkpoint_index)
+        for name in ['throttle', 'sizer', 'max_retries', 'native', 'poll_interval', 'callbacks', 'progress_interval',
+                     'transforms', 'transform_processes', 'changed_field', 'catch_up_passes', 'catch_up_threshold',
+                     '_version', '_process_pool']:
+            setattr(reindexer, name, getattr(self, name))
+        return reindexer
+
+    def stop(self):
+        """Makes a running reindex give up at its next bulk request or task poll."""
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def _check_stopped(self):
+        if self._stop.is_set():
+            raise ReindexStopped("Reindex stopped")
+
+    def do_reindex(self, source_index, target_index, sleep_time=None, resume=False, online=False, dual_write=False):
+        """Copies source_index into target_index, returning whether every document made it.
+
+        Online, the source stays writable during the copy and is only write
+        blocked for the last catch up pass. It is left blocked when the
+        reindex succeeds, for the caller to move aliases and then unblock it.
+        Deletes made to the source during an online reindex aren't copied.
+
+        With dual_write, producers are writing to both indexes, so the source
+        isn't blocked and documents already in the target are left alone.
+        Documents deleted from both before they are copied come back.
+        """
+        if online and not self.changed_field:
+            raise InvalidConfigError("An online reindex needs a changed field.")
+        if sleep_time and float(sleep_time) > 0 and not self.throttle.enabled:
+            # The old per scroll page pause, as an equivalent document rate. 0 is no pause.
+            self.throttle.set_rate(docs_per_second=self.sizer.scan_size / float(sleep_time))
 
-    def do_reindex(self, source_index, target_index, sleep_time):
         # Block updates to docs in source index
-        self._set_read_only(source_index, True)
-        self._set_scroll_sleep(sleep_time)
-        scan_kwargs = {'size': 200}
+        block = not (online or dual_write)
+        if block:
+            self.set_write_block(source_index, True)
+        self._op_type = 'create' if dual_write else 'index'
 
+        self.progress = ReindexProgress(self._count(source_index))
+        self._reported = time.time()
+        self._task_id = None
+        done = False
         try:
-            logger.warn("Scroll start: %s" % str(datetime.datetime.now().time()))
-            # Using the python client reindex helper instead of native reindex api because it's not available until 2.3
-            errors = reindex(self.client, source_index, target_index, scan_kwargs=scan_kwargs)
-            if errors:
-                for err in errors:
-                    logger.error('Error: %s' % err)
+            mark = self._max_value(source_index, self.changed_field) if online else None
+            if self.use_native(resume):
+                done = not self._native_reindex(source_index, target_index).get('failures')
+            else:
+                done = not self._scroll_reindex(source_index, target_index, resume)
+            if done and online:
+                done = self._catch_up(source_index, target_index, mark)
         except Exception as e:
-            logger.exception("Reindex operation failed: %s" % e.message)
+            logger.exception("Reindex operation failed: %s" % e)
+        finally:
+            if self._task_id and block:
+                logger.error("Leaving %s write blocked, reindex task %s may still be copying it. Cancel the task "
+                             "before lifting the block." % (source_index, self._task_id))
+            elif self._task_id:
+                logger.error("Reindex task %s may still be copying %s, cancel it by hand." % (
+                    self._task_id, source_index))
+            elif block or (online and not done):
+                self.set_write_block(source_index, False)
+            self.progress.finish()
+            logger.warn("Reindex of %s to %s: %s" % (source_index, target_index,
+                                                     ReindexProgress.describe(self.progress.stats())))
+            self._report(force=True)
+        return done
+
+    def _catch_up(self, source_index, target_index, mark):
+        """Copies documents changed since ``mark``, write blocking the source for the final pass."""
+        for _ in range(self.catch_up_passes):
+            changed = self._count_docs(source_index, self._changed_since(mark))
+            if changed <= self.catch_up_threshold:
+                break
+            logger.warn("Catching up on %s documents changed in %s" % (changed, source_index))
+            next_mark = self._max_value(source_index, self.changed_field)
+            if self._copy_partition(source_index, target_index, self._changed_since(mark))[1]:
+                return False
+            mark = next_mark
+
+        self.set_write_block(source_index, True)
+        logger.warn("Copying the last changes to %s with writes blocked" % source_index)
+        return not self._copy_partition(source_index, target_index, self._changed_since(mark))[1]
+
+    def _changed_since(self, mark):
+        field = self.changed_field
+        if mark is None:
+            return {'query': {'exists': {'field': field}}}
+        # Documents at the mark may have changed after it was read, so they go again.
+        return {'query': {'range': {field: {'gte': mark}}}}
+
+    def _max_value(self, index, field):
+        resp = self.client.search(index=index, body={'size': 0, 'aggs': {'max': {'max': {'field': field}}}})
+        return resp['aggregations']['max']['value']
+
+    def _count(self, index):
+        try:
+            return self.client.count(index=index)['count']
+        except Exception:
+            logger.warn("Couldn't count %s, no ETA for its reindex" % index)
+            return None
+
+    def _report(self, force=False):
+        with self._report_lock:
+            if not force and time.time() - self._reported < self.progress_interval:
+                return
+            self._reported = time.time()
+        stats = self.progress.stats()
+        for callback in self.callbacks:
+            try:
+                callback(stats)
+            except Exception:
+                logger.exception("Reindex progress callback failed")
+
+    def _scroll_reindex(self, source_index, target_index, resume=False):
+        """Copies with scan and bulk, for clusters without a task based _reindex."""
+        logger.warn("Scroll start: %s" % str(datetime.datetime.now().time()))
+        owns_pool = self._process_pool is None
+        self.start_transform_pool()
+        try:
+            checkpoint = self._checkpoint(source_index, target_index, resume)
+            if checkpoint:
+                partitions = checkpoint.pending()
+            else:
+                partitions = list(enumerate(self._partitions(source_index)))
+
+            results = self._map(lambda (i, query): self._copy_partition(source_index, target_index, query, i, checkpoint),
+                                partitions)
+            errors = sum(failed for _, failed in results)
+            if errors:
+                logger.error('Error: %s documents failed to reindex' % errors)
+            return errors
         finally:
+            if owns_pool:
+                self.stop_transform_pool()
             logger.warn("Scroll end: %s" % str(datetime.datetime.now().time()))
-            self._set_read_only(source_index, False)
-            self.client.scroll = self.builtin_scroll
 
-    def _set_read_only(self, index, read_only):
-        read_only_setting = {"index": {"blocks": {"write": read_only}}}
-        self.client.indices.put_settings(index=index, body=read_only_setting)
+    def start_transform_pool(self):
+        """Starts the processes in_pool transform stages run in, if there are any.
+
+        Forking while other threads run can deadlock the children on locks
+        those threads hold, so the pool has to be started before any are,
+        e.g. before reindexing an alias or watching the schema. Reindexes
+        started after share it, clones included.
+        """
+        if self._process_pool is None and self.transform_processes and any(s.in_pool for s in self.transforms):
+            if threading.active_count() > 1:
+                raise InvalidConfigError("The transform process pool must be started before any other threads.")
+            self._process_pool = Pool(self.transform_processes)
+        return self._process_pool
+
+    def stop_transform_pool(self):
+        if self._process_pool:
+            self._process_pool.terminate()
+            self._process_pool = None
+
+    @staticmethod
+    def _map(func, partitions):
+        """Runs func on every partition, concurrently when there are several."""
+        if len(partitions) <= 1:
+            return map(func, partitions)
+        pool = ThreadPool(len(partitions))
+        try:
+            result = pool.map_async(func, partitions)
+            # Waiting without a timeout can't be interrupted under Python 2,
+            # which holds off signal handlers, e.g. rethrottling, until the end.
+            while not result.ready():
+                result.wait(1)
+            return result.get()
+        finally:
+            pool.close()
+            pool.join()
 
-    def _set_scroll_sleep(self, sleep_time):
-        # Reindex helper uses scan/scroll and bulk update.  This scroll sleep helps prevent overloading the server
-        def scroll_sleep(*args, **kwargs):
-            time.sleep(float(sleep_time))  # seconds
-            return self.builtin_scroll(*args, **kwargs)
+    def verify(self, source_index, target_index, sample_size=0):
+        """Compares source and target a partition at a time, concurrently.
 
-        self.builtin_scroll = self.client.scroll
-        self.client.scroll = scroll_sleep
+        Returns a report per partition with both document counts and, when
+        sample_size is set, whether that many source documents are the same
+        in the target, after any transforms. A partition is ok unless the
+        target is short or a sampled document differs.
+        """
+        def check((i, query)):
+            report = {'partition': i, 'source': self._count_docs(source_index, query),
+                      'target': self._count_docs(target_index, query), 'sample': None}
+            if sample_size:
+                report['sample'] = self._sample_matches(source_index, target_index, query, sample_size)
+            report['ok'] = report['target'] >= report['source'] and report['sample'] is not False
+            return report
+        partitions = self._partitions(source_index)
+        if any(p and 'slice' in p for p in partitions) and self._shards(source_index) != self._shards(target_index):
+            # Which slice a document is in depends on its index's shards, so only the totals compare.
+            partitions = [None]
+        return self._map(check, list(enumerate(partitions)))
 
+    def _shards(self, index):
+        """The shard count of each index behind ``index``."""
+        try:
+            settings = self.client.indices.get_settings(index=index, name='index.number_of_shards')
+        except NotFoundError:
+            return None
+        return sorted(int(s['settings']['index']['number_of_shards']) for s in settings.values())
+
+    def _count_docs(self, index, query):
+        query = dict(query or {})
+        try:
+            if 'slice' not in query:
+                return self.client.count(index=index, body=query or None)['count']
+            # Slices are only for scrolls, whose first page has the slice's total.
+            query['size'] = 1
+            resp = self.client.search(index=index, body=query, scroll='1m')
+            self.client.clear_scroll(scroll_id=resp['_scroll_id'])
+            return resp['hits']['total']
+        except NotFoundError:
+            return 0
+
+    def _sample_matches(self, source_index, target_index, query, sample_size):
+        query = dict(query or {}, size=sample_size)
+        resp = self.client.search(index=source_index, body=query, scroll='1m')
+        self.client.clear_scroll(scroll_id=resp['_scroll_id'])
+        hits = resp['hits']['hits']
+        if self.transforms:
+            hits = list(pipeline(hits, self.transforms))
+        if not hits:
+            return True
+        docs = []
+        for hit in hits:
+            doc = {'_type': hit['_type'], '_id': hit['_id']}
+            if '_routing' in hit:
+                doc['_routing'] = hit['_routing']
+            docs.append(doc)
+        try:
+            found = self.client.mget(index=target_index, body={'docs': docs})['docs']
+        except NotFoundError:
+            return False
+        found = {(d['_type'], d['_id']): d['_source'] for d in found if d.get('found')}
+        return (checksum((h['_type'], h['_id'], h['_source']) for h in hits) ==
+                checksum((h['_type'], h['_id'], found.get((h['_type'], h['_id']))) for h in hits))
+
+    def _checkpoint(self, source_index, target_index, resume):
+        if not self.checkpoint_index:
+            return None
+        if resume:
+            checkpoint = ReindexCheckpoint.load(self.client, self.checkpoint_index, source_index, target_index)
+            if checkpoint:
+                logger.warn("Resuming reindex of %s with %s partitions left" % (source_index, len(checkpoint.pending())))
+                return checkpoint
+            logger.warn("No checkpoint to resume %s from, starting over" % source_index)
+        return ReindexCheckpoint.create(self.client, self.checkpoint_index, source_index, target_index,
+                                        self._partitions(source_index), self.slice_field)
+
+    def use_native(self, resume=False):
+        """Whether to copy with the server's _reindex rather than scan and bulk.
+
+        _reindex only runs as a pollable task from 5.0. The helper is also
+        used to resume, as only it keeps checkpoints, and to transform.
+        """
+        if resume or self.transforms or self.native is False:
+            return False
+        return self.server_version() >= (5, 0)
+
+    def _native_reindex(self, source_index, target_index):
+        body = {'source': {'index': source_index, 'size': self.sizer.scan_size}, 'dest': {'index': target_index}}
+        if self._op_type == 'create':
+            body['dest']['op_type'] = 'create'
+            body['conflicts'] = 'proceed'
+        params = {'wait_for_completion': 'false'}
+        if self.workers > 1 and self.server_version() >= (5, 1):
+            params['slices'] = self.workers
+        rate = self.throttle.docs_per_second
+        if rate:
+            params['requests_per_second'] = rate
+        if self.throttle.bytes_per_second:
+            logger.warn("_reindex can't limit bytes per second, only documents")
+
+        logger.warn("Reindex start: %s" % str(datetime.datetime.now().time()))
+        _, resp = self.client.transport.perform_request('POST', '/_reindex', params=params, body=body)
+        task_id = self._task_id = resp['task']
+        logger.info("Reindexing %s to %s in task %s" % (source_index, target_index, task_id))
+        try:
+            while True:
+                _, task = self.client.transport.perform_request('GET', '/_tasks/%s' % task_id)
+                if task.get('completed'):
+                    break
+                self._check_stopped()
+                self._task_progress(task['task'].get('status', {}))
+                self._report()
+                time.sleep(self.poll_interval)
+                if self.throttle.docs_per_second != rate:
+                    rate = self.throttle.docs_per_second
+                    self.client.transport.perform_request('POST', '/_reindex/%s/_rethrottle' % task_id,
+                                                          params={'requests_per_second': rate or -1})
+        except BaseException:
+            self._cancel_task(task_id)
+            raise
+        self._task_id = None
+        logger.warn("Reindex end: %s" % str(datetime.datetime.now().time()))
+
+        if 'error' in task:
+            raise Exception("Reindex task %s failed: %s" % (task_id, task['error']))
+        response = task.get('response', {})
+        failures = response.get('failures') or []
+        self._task_progress(dict(response, failures=len(failures)))
+        for failure in failures:
+            logger.error('Error: %s' % failure)
+        logger.info("Copied %s documents from %s to %s, %s failed" % (
+            response.get('created', 0) + response.get('updated', 0), source_index, target_index, len(failures)))
+        if failures:
+            logger.error('Error: %s documents failed to reindex' % len(failures))
+        return response
+
+    def _cancel_task(self, task_id):
+        try:
+            self.client.transport.perform_request('POST', '/_tasks/%s/_cancel' % task_id)
+        except Exception:
+            logger.exception("Couldn't cancel reindex task %s" % task_id)
+            return
+        logger.warn("Cancelled reindex task %s" % task_id)
+        self._task_id = None
+
+    def _task_progress(self, status):
+        """Copies a _reindex task's status into the progress counters."""
+        written = status.get('created', 0) + status.get('updated', 0)
+        retries = status.get('retries', 0)
+        if isinstance(retries, dict):
+            retries = sum(retries.values())
+        self.progress.update(total=status.get('total', self.progress.total), written=written, retries=retries,
+                             failed=status.get('failures', 0), requests=status.get('batches', 0),
+                             scanned=written + status.get('noops', 0) + status.get('version_conflicts', 0))
+
+    def server_version(self):
+        if self._version is None:
+            self._version = tuple(int(v) for v in self.client.info()['version']['number'].split('.')[:2])
+        return self._version
+
+    def _partitions(self, source_index):
+        """Query bodies splitting the source into ``workers`` partitions."""
+        if self.workers <= 1:
+            return [None]
+        if self.server_version() >= (5, 0):
+            return [{'slice': {'id': i, 'max': self.workers}} for i in range(self.workers)]
+        if not self.slice_field:
+            logger.warn("Sliced scroll needs ES 5.0, set a slice field to reindex %s in parallel" % source_index)
+            return [None]
+        return self._range_partitions(source_index)
+
+    def _range_partitions(self, source_index):
+        field = self.slice_field
+        aggs = {'min': {'min': {'field': field}}, 'max': {'max': {'field': field}}}
+        resp = self.client.search(index=source_index, body={'size': 0, 'aggs': aggs})
+        low, high = resp['aggregations']['min']['value'], resp['aggregations']['max']['value']
+        if low is None or high is None:
+            return [None]
+
+        # Docs missing the field go with the first partition.
+        step = (high - low) / float(self.workers)
+        edges = [int(math.floor(low + step * i)) for i in range(1, self.workers)]
+        partitions = []
+        for i in range(self.workers):
+            bounds = {}
+            if i > 0:
+                bounds['gte'] = edges[i - 1]
+            if i < self.workers - 1:
+                bounds['lt'] = edges[i]
+            query = {'range': {field: bounds}}
+            if i == 0:
+                query = {'bool': {'should': [query, {'bool': {'must_not': {'exists': {'field': field}}}}]}}
+            partitions.append({'query': query})
+        return partitions
+
+    def _copy_partition(self, source_index, target_index, query, partition_id=0, checkpoint=None):
+        sort_field = checkpoint and checkpoint.sort_field
+        hits = pipeline(self._scan(source_index, query, sort_field), self.transforms, self._process_pool)
+        success = failed = 0
+        for chunk, last_sort in self._chunks(self._actions(hits, target_index)):
+            ok, errors = self._send(chunk)
+            success += ok
+            failed += errors
+            # A resume starts from the last key, so it only moves while everything before it made it.
+            # Documents missing the key sort last and are always copied again.
+            if sort_field and not failed and last_sort and last_sort[0] is not None:
+                checkpoint.advance(partition_id, last_sort[0])
+        if checkpoint and not failed:
+            checkpoint.complete(partition_id)
+        logger.info("Copied %s documents from %s to %s, %s failed" % (success, source_index, target_index, failed))
+        return success, failed
+
+    def _chunks(self, actions):
+        """Serializes actions into bulk chunks bounded by the sizer's current limits.
+
+        Yields each chunk with the sort values of its last document, if sorted.
+        """
+        serializer = self.client.transport.serializer
+        chunk, size, last_sort = [], 0, None
+        max_docs, max_size = self.sizer.limits
+        for action in actions:
+            sort = action.get('sort')
+            action, data = expand_action(action)
+            lines = [serializer.dumps(action), serializer.dumps(data)]
+            line_size = len(lines[0]) + len(lines[1]) + 2
+            if chunk and (len(chunk) >= max_docs or size + line_size > max_size):
+                yield chunk, last_sort
+                chunk, size = [], 0
+                max_docs, max_size = self.sizer.limits
+            chunk.append(lines)
+            size += line_size
+            last_sort = sort
+        if chunk:
+            yield chunk, last_sort
+
+    def _send(self, chunk):
+        """Bulk writes a chunk, retrying whatever ES rejects with backoff.
+
+        Returns the number of documents written and failed.
+        """
+        success = failed = 0
+        attempt = 0
+        while chunk:
+            self._check_stopped()
+            size = sum(len(a) + len(d) + 2 for a, d in chunk)
+            if self.throttle.enabled:
+                self.throttle.wait(len(chunk), size)
+            start = time.time()
+            try:
+                resp = self.client.bulk('\n'.join(line for lines in chunk for line in lines) + '\n')
+            except TransportError as e:
+                if e.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.progress.add_retry()
+                time.sleep(self.sizer.rejected(attempt))
+                continue
+            latency = time.time() - start
+
+            rejected = []
+            written = errors = 0
+            for lines, item in zip(chunk, resp['items']):
+                item = item.values()[0]
+                if 200 <= item.get('status', 500) < 300:
+                    written += 1
+                elif item.get('status') == 409 and self._op_type == 'create':
+                    # Already written to the target by a producer, which is newer.
+                    written += 1
+                elif item.get('status') == 429 or 'es_rejected_execution_exception' in str(item.get('error')):
+                    rejected.append(lines)
+                else:
+                    errors += 1
+                    logger.error('Error: %s' % item)
+
+            if not rejected:
+                self.sizer.succeeded(latency, len(chunk))
+            elif attempt < self.max_retries:
+                attempt += 1
+                self.progress.add_retry()
+                time.sleep(self.sizer.rejected(attempt))
+            else:
+                errors += len(rejected)
+                rejected = []
+            self.progress.add_bulk(latency, written, errors, size)
+            self._report()
+            success += written
+            failed += errors
+            chunk = rejected
+        return success, failed
+
+    def _scan(self, source_index, query, sort_field=None):
+        query = dict(query or {})
+        kwargs = {'size': self.sizer.scan_size}
+        if sort_field:
+            # Sorted so a checkpoint's last key marks everything before it as copied.
+            query['sort'] = [{sort_field: {'order': 'asc', 'missing': '_last'}}]
+            kwargs['preserve_order'] = True
+        elif self.server_version() >= (5, 0):
+            # search_type=scan is gone in 5.0, scroll in _doc order instead.
+            query.setdefault('sort', ['_doc'])
+            kwargs['preserve_order'] = True
+        if self.server_version() < (5, 0):
+            kwargs['fields'] = ('_source', '_parent', '_routing', '_timestamp')
+        for hit in scan(self.client, query=query or None, index=source_index, scroll='5m', **kwargs):
+            self.progress.add_scanned()
+            yield hit
+
+    def _actions(self, hits, target_index):
+        for hit in hits:
+            hit['_index'] = target_index
+            if self._op_type != 'index':
+                hit['_op_type'] = self._op_type
+            if 'fields' in hit:
+                hit.update(hit.pop('fields'))
+            yield hit
+
+    def set_write_block(self, index, read_only):
+        read_only_setting = {"index": {"blocks": {"write": read_only}}}
+        self.client.indices.put_settings(index=index, body=read_only_setting)
@@ -0,0 +1,142 @@
+import datetime
+import logging
+import threading
+import time
+
+from elasticsearch.exceptions import NotFoundError
+from pseudonym.models import Schema
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+class ReindexScheduler(object):
+    """Reindexes and cuts over every index of an alias, several at a time.
+
+    At most ``concurrency`` indexes are reindexed at once, and at most
+    ``per_node`` of those may have shards on any one node. The state of
+    each index is kept in the schema index, so a run can be resumed. The
+    other options are passed to ``SchemaManager.reindex`` for every index.
+    """
+    doc_type = 'reindex_run'
+    poll_interval = 1
+
+    def __init__(self, manager, alias_name, concurrency=2, per_node=1, sample_size=0, sleep_time=None,
+                 force_merge=None, online=False, dual_write=False):
+        self.manager = manager
+        self.client = manager.client
+        self.alias_name = alias_name
+        self.concurrency = concurrency
+        self.per_node = per_node
+        self.sample_size = sample_size
+        self.sleep_time = sleep_time
+        self.force_merge = force_merge
+        self.online = online
+        self.dual_write = dual_write
+        self.states = {}
+        self._nodes_by_index = {}
+        self._lock = threading.Lock()
+
+    def run(self, resume=False):
+        """Returns the final state of each index."""
+        states = self._load() if resume else None
+        if states is None:
+            _, schema = self.manager.get_current_schema(True)
+            alias = Schema.from_json(schema).aliases.get(self.alias_name)
+            if alias is None:
+                raise Exception("Alias %s does not exist." % self.alias_name)
+            states = {name: PENDING for name in alias['indexes']}
+        self.states = states
+        self._save()
+
+        # Anything started before was checkpointed, so picks up where it left off.
+        pending = sorted(name for name, state in states.items() if state != DONE)
+        resuming = {name for name in pending if states[name] != PENDING}
+        running = {}
+        try:
+            self._schedule(pending, resuming, running)
+        except BaseException:
+            # Let the running reindexes put their indexes' settings back before going.
+            logger.warn("Stopping the reindexes of %s still running" % self.alias_name)
+            for _, _, reindexer in running.values():
+                reindexer.stop()
+            for thread, _, _ in running.values():
+                while thread.is_alive():
+                    thread.join(1)
+            raise
+
+        logger.warn("Reindexed %s: %s" % (self.alias_name, ', '.join(
+            '%s %s' % (name, state) for name, state in sorted(self.states.items()))))
+        return dict(self.states)
+
+    def _schedule(self, pending, resuming, running):
+        while pending or running:
+            for name, (thread, _, _) in running.items():
+                if not thread.is_alive():
+                    del running[name]
+
+            load = {}
+            for _, nodes, _ in running.values():
+                for node in nodes:
+                    load[node] = load.get(node, 0) + 1
+            for name in pending[:]:
+                if len(running) >= self.concurrency:
+                    break
+                nodes = self._nodes(name)
+                if running and any(load.get(node, 0) >= self.per_node for node in nodes):
+                    continue
+                reindexer = self.manager.reindexer.clone()
+                thread = threading.Thread(target=self._migrate, args=(name, name in resuming, reindexer))
+                thread.start()
+                running[name] = (thread, nodes, reindexer)
+                pending.remove(name)
+                for node in nodes:
+                    load[node] = load.get(node, 0) + 1
+            if running:
+                time.sleep(self.poll_interval)
+
+    def _nodes(self, index_name):
+        """The nodes with a copy of any shard of the index."""
+        if index_name not in self._nodes_by_index:
+            try:
+                resp = self.client.search_shards(index=index_name)
+                nodes = {copy['node'] for shard in resp['shards'] for copy in shard if copy.get('node')}
+            except NotFoundError:
+                nodes = set()
+            self._nodes_by_index[index_name] = nodes
+        return self._nodes_by_index[index_name]
+
+    def _migrate(self, index_name, resume, reindexer):
+        self._set(index_name, RUNNING)
+        state = FAILED
+        try:
+            done = self.manager.reindex(index_name, sleep_time=self.sleep_time, resume=resume,
+                                        force_merge=self.force_merge, online=self.online, dual_write=self.dual_write,
+                                        reindexer=reindexer, sample_size=self.sample_size)
+            # Online reindexes cut over themselves, while the source is write blocked.
+            if done and (self.online or self.manager.reindex_cutover(index_name, self.sample_size)):
+                state = DONE
+        except Exception as e:
+            logger.exception("Reindex of %s failed: %s" % (index_name, e))
+        self._set(index_name, state)
+
+    def _set(self, index_name, state):
+        with self._lock:
+            self.states[index_name] = state
+            self._save()
+
+    @property
+    def doc_id(self):
+        return self.alias_name
+
+    def _load(self):
+        try:
+            doc = self.client.get(index=self.manager.schema_index, doc_type=self.doc_type, id=self.doc_id)
+        except NotFoundError:
+            return None
+        return doc['_source']['indexes']
+
+    def _save(self):
+        body = {'alias': self.alias_name, 'indexes': self.states, 'updated': datetime.datetime.utcnow().isoformat()}
+        self.client.index(index=self.manager.schema_index, doc_type=self.doc_type, id=self.doc_id, body=body)
@@ -0,0 +1,129 @@
+import json
+import logging
+import marshal
+import os
+import tempfile
+
+from pseudonym.errors import RoutingException
+from pseudonym.models import Schema
+from pseudonym.strategy import Strategies
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+
+
+def _router_signature(index_map, alias):
+    # A router only depends on its alias's strategy and member indexes.
+    members = [index_map.get(name, {}) for name in sorted(alias.get('indexes', []))]
+    return (json.dumps(alias.get('strategy'), sort_keys=True),
+            tuple((i.get('name'), i.get('routing')) for i in members))
+
+
+class SchemaSnapshot(object):
+    """One schema version together with every router compiled from it.
+
+    Snapshots are built completely before they are published and never
+    change afterwards, so readers on any thread can route from one without
+    locking. Routers whose alias is unchanged since ``previous`` are reused.
+    """
+    def __init__(self, meta, schema, previous=None):
+        self.meta = meta
+        self.schema = schema
+        self.strategies = {}
+        self.routers = {}
+        self.signatures = {}
+        self._errors = {}
+        # Index name -> index it is being migrated to, see SchemaManager.reindex.
+        self.migrations = schema.get('migrations', {})
+
+        self.model = Schema.from_json(schema)
+        for alias in self.model.aliases.values():
+            name = alias['name']
+            # One broken alias only makes routing to that alias fail.
+            try:
+                strategy = self.strategies[name] = Strategies[alias['strategy'].keys()[0]].instance()
+                signature = self.signatures[name] = _router_signature(self.model.indexes, alias)
+                if previous and name in previous.routers and previous.signatures[name] == signature:
+                    self.routers[name] = previous.routers[name]
+                    continue
+                self.routers[name] = strategy.get_router(self.model, alias)
+            except RoutingException, e:
+                self._errors[name] = e
+            except Exception, e:
+                logger.exception("Cannot build a router for %s" % name)
+                self._errors[name] = RoutingException("Cannot route to %s: %s" % (name, e))
+
+    @property
+    def version(self):
+        return self.meta['_version']
+
+    def get_router(self, alias_name):
+        try:
+            return self.routers[alias_name]
+        except KeyError:
+            if alias_name in self._errors:
+                raise self._errors[alias_name]
+            raise RoutingException("%s is not in the schema." % alias_name)
+
+    def dump(self, path):
+        """Writes the snapshot to ``path`` for fast startup of other workers.
+
+        The file is a one line JSON header keyed by the schema ``_version``,
+        followed by the marshalled schema, so loading it is a marshal decode
+        instead of a JSON parse. It is replaced atomically, unless it already
+        holds a newer version. Returns whether it was written.
+        """
+        header = {'format': SNAPSHOT_FORMAT, 'marshal': marshal.version, 'meta': self.meta}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(header) + '\n')
+                marshal.dump(self.schema, f, marshal.version)
+            # mkstemp makes it private, other workers' users may need to read it.
+            os.chmod(tmp_path, 0644)
+            current = _snapshot_version(path)
+            if current is not None and current > self.version:
+                logger.info("Not replacing schema snapshot %s, it has newer version %s" % (path, current))
+                os.remove(tmp_path)
+                return False
+            os.rename(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    @classmethod
+    def load(cls, path, previous=None):
+        """Loads a snapshot written by ``dump``, or returns None if there is no usable one."""
+        try:
+            with open(path, 'rb') as f:
+                header = _read_header(f)
+                if not header:
+                    return None
+                schema = marshal.load(f)
+        except (IOError, OSError):
+            return None
+        except (ValueError, EOFError, TypeError, AttributeError):
+            logger.warn("Ignoring unreadable schema snapshot %s" % path)
+            return None
+        return cls(header['meta'], schema, previous)
+
+
+def _read_header(f):
+    """The header of a snapshot file, or None if it's from another format or Python."""
+    header = json.loads(f.readline())
+    if header.get('format') != SNAPSHOT_FORMAT or header.get('marshal') != marshal.version:
+        return None
+    return header
+
+
+def _snapshot_version(path):
+    """The schema version in the snapshot at ``path``, None without a readable one."""
+    try:
+        with open(path, 'rb') as f:
+            header = _read_header(f)
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+    return header and header['meta']['_version']
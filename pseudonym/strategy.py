@@ -1,9 +1,12 @@
+import bisect
+import calendar
 import datetime
 import math
+from operator import itemgetter
 from pseudonym.errors import InvalidConfigError
 from pseudonym.errors import RoutingException
 from pseudonym.filter import IndexFilter
-from pseudonym.models import Index
+from pseudonym.models import Schema
 from pseudonym.filter import str_to_slice
 
 
@@ -25,21 +28,147 @@ class BaseRouter(object):
     def route(self, routing):
         raise NotImplementedError()
 
+    def export(self):
+        """Describes the router as plain data, see ``pseudonym.table``."""
+        raise NotImplementedError()
+
+    def route_many(self, items, key=None):
+        """Groups ``items`` by the name of the index they route to.
+
+        ``key`` extracts the routing value from an item, by default the item
+        itself is the routing value.
+        """
+        groups = {}
+        for item in items:
+            index = self.route(item if key is None else key(item))
+            groups.setdefault(index['name'], []).append(item)
+        return groups
+
 
 class AliasRouter(BaseRouter):
     def route(self, _):
         return self.alias
 
+    def export(self):
+        return {'type': 'alias', 'names': [self.alias['name']]}
+
 
 class RangeRouter(BaseRouter):
+    """Routes to the newest index whose routing is <= the given value.
+
+    ``indexes`` are expected newest first (see ``list_indexes``). Values older
+    than every index fall through to the oldest one.
+    """
+    def __init__(self, indexes, alias):
+        super(RangeRouter, self).__init__(indexes, alias)
+        if not indexes:
+            raise RoutingException("%s has no indexes" % alias['name'])
+        # Ascending boundaries, so bisect_right picks the last index in the
+        # original (descending) order among equal routings.
+        self._indexes = indexes[::-1]
+        self._keys = [self.routing_key(index) for index in self._indexes]
+
+    def routing_key(self, index):
+        return index['routing']
+
+    def export(self):
+        return {'type': 'range', 'names': [i['name'] for i in self._indexes], 'keys': self._keys}
+
+    def route(self, routing):
+        pos = bisect.bisect_right(self._keys, routing)
+        return self._indexes[pos - 1 if pos else 0]
+
+    def route_many(self, items, key=None):
+        # Sort once, then cut the sorted run at each index boundary instead of
+        # routing every item on its own.
+        if key is None:
+            items = keys = sorted(items)
+        else:
+            decorated = sorted([(key(item), item) for item in items], key=itemgetter(0))
+            keys = [k for k, _ in decorated]
+            items = [item for _, item in decorated]
+
+        groups = {}
+        start = 0
+        for pos in xrange(1, len(self._keys)):
+            if start == len(keys):
+                break
+            end = bisect.bisect_left(keys, self._keys[pos], start)
+            if end > start:
+                groups.setdefault(self._indexes[pos - 1]['name'], []).extend(items[start:end])
+                start = end
+        if start < len(keys):
+            groups.setdefault(self._indexes[-1]['name'], []).extend(items[start:])
+        return groups
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_PARSED_DATES = {}
+_MAX_PARSED_DATES = 10000
+
+
+def parse_date_routing(routing):
+    """Parses a date routing string to epoch seconds, memoized per string."""
+    try:
+        return _PARSED_DATES[routing]
+    except KeyError:
+        parsed = datetime.datetime.strptime(routing, '%Y-%m-%dT%H:%M:%S')
+        if len(_PARSED_DATES) >= _MAX_PARSED_DATES:
+            _PARSED_DATES.clear()
+        epoch = _PARSED_DATES[routing] = calendar.timegm(parsed.timetuple())
+        return epoch
+
+
+def to_epoch(value):
+    if isinstance(value, datetime.datetime):
+        delta = value - _EPOCH
+        return delta.days * 86400 + delta.seconds
+    if isinstance(value, datetime.date):
+        return (value.toordinal() - _EPOCH_ORDINAL) * 86400
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return value
+    # Anything else, e.g. a date string, would compare wrongly with the epoch seconds.
+    raise RoutingException("Cannot route by %r, routing must be a date, datetime or epoch seconds." % (value,))
+
+
+class DateRangeRouter(RangeRouter):
+    """RangeRouter over epoch second boundaries, routing dates and datetimes."""
+    def routing_key(self, index):
+        routing = index['routing']
+        if isinstance(routing, (int, long)):
+            return routing
+        return parse_date_routing(routing)
+
+    def export(self):
+        exported = super(DateRangeRouter, self).export()
+        exported['type'] = 'date_range'
+        return exported
+
     def route(self, routing):
-        for index in self.indexes:
-            if routing >= index['routing']:
-                return index
-        if not index:
-            raise RoutingException("%s has no indexes" % self.alias['name'])
+        return super(DateRangeRouter, self).route(to_epoch(routing))
+
+    def route_many(self, items, key=None):
+        if key is None:
+            epoch_key = to_epoch
+        else:
+            epoch_key = lambda item: to_epoch(key(item))
+        return super(DateRangeRouter, self).route_many(items, epoch_key)
+
 
-        return index
+def write_indexes(name, migrations):
+    """The indexes a write routed to ``name`` goes to, its migration target too while one runs."""
+    target = migrations.get(name)
+    return [name, target] if target else [name]
+
+
+def write_groups(groups, migrations):
+    """Adds the items routed to each migrating index under its target as well."""
+    groups = dict(groups)
+    for name, items in groups.items():
+        if name in migrations:
+            groups.setdefault(migrations[name], []).extend(items)
+    return groups
 
 
 _INST = {}
@@ -67,7 +196,8 @@ class RoutingStrategy(object):
         return indexes
 
     def list_indexes(self, schema, alias):
-        return [i for i in schema['indexes'] if i['name'] in set(alias['indexes'])]
+        # Routers hand these out from route(), so they are plain dicts.
+        return [index.to_dict() for index in Schema.of(schema).in_order(alias['indexes'])]
 
     def get_router(self, schema, alias):
         if not self.Router:
@@ -81,7 +211,7 @@ class IndexPointerStrategy(RoutingStrategy):
         return []
 
     def link_indexes(self, schema, alias, cfg, new_indexes):
-        return [i['name'] for i in schema['indexes'] if i['name'] in set(cfg['indexes'])]
+        return [i.name for i in Schema.of(schema).in_order(cfg['indexes'])]
 
 
 @register('appending_pointer')
@@ -102,7 +232,7 @@ class AppendingPointerStrategy(RoutingStrategy):
         return list(indexes)
 
     def _get_initial(self, schema, alias, cfg):
-        indexes = [index for index in schema['indexes'] if index['alias'] in cfg['aliases']]
+        indexes = Schema.of(schema).indexes_of(cfg['aliases'])
 
         try:
             indexes = sorted(indexes, key=lambda x: x['routing'], reverse=True)
@@ -123,7 +253,7 @@ class AliasPointerStrategy(RoutingStrategy):
 
     def link_indexes(self, schema, alias, cfg, new_indexes):
         index_filter = IndexFilter(aliases=cfg['aliases'], slice=cfg.get('slice'))
-        return [index.name for index in index_filter.filter([Index(**i) for i in schema['indexes']])]
+        return [index.name for index in index_filter.filter([i.index for i in Schema.of(schema).indexes.values()])]
 
     def list_indexes(self, schema, alias):
         indexes = super(AliasPointerStrategy, self).list_indexes(schema, alias)
@@ -151,8 +281,11 @@ class SingleIndexRoutingStrategy(RoutingStrategy):
         def route(self, routing):
             return self.indexes[0]
 
+        def export(self):
+            return {'type': 'alias', 'names': [self.indexes[0]['name']]}
+
     def create_indexes(self, schema, alias, cfg):
-        if alias['name'] not in {i['name'] for i in schema['indexes']}:
+        if alias['name'] not in Schema.of(schema).indexes:
             return [{'name': alias['name'], 'alias': alias['name']}]
         return []
 
@@ -162,20 +295,15 @@ class SingleIndexRoutingStrategy(RoutingStrategy):
 
 @register('date')
 class DateRoutingStrategy(RoutingStrategy):
-    Router = RangeRouter
+    Router = DateRangeRouter
 
     def create_indexes(self, schema, alias, cfg):
-        existing = {i['name'] for i in schema['indexes']}
+        existing = Schema.of(schema).indexes
         return [{'name': name, 'routing': routing, 'alias': alias['name']} for name, routing in cfg['indexes'].items() if name not in existing]
 
     def list_indexes(self, schema, alias):
         indexes = super(DateRoutingStrategy, self).list_indexes(schema, alias)
-        adapted_indexes = []
-        for index in indexes:
-            adapted_index = index.copy()
-            adapted_index['routing'] = datetime.datetime.strptime(index['routing'], '%Y-%m-%dT%H:%M:%S')
-            adapted_indexes.append(adapted_index)
-        return sorted(adapted_indexes, key=lambda x: x['routing'], reverse=True)
+        return sorted(indexes, key=lambda x: parse_date_routing(x['routing']), reverse=True)
 
 
 class CalendarRoutingStrategy(DateRoutingStrategy):
@@ -184,8 +312,7 @@ class CalendarRoutingStrategy(DateRoutingStrategy):
 
     def create_indexes(self, schema, alias, cfg):
         next_index = self.get_next(cfg)
-        existing = {i['name'] for i in schema['indexes']}
-        if next_index['name'] not in existing:
+        if next_index['name'] not in Schema.of(schema).indexes:
             next_index['alias'] = alias['name']
             return [next_index]
         return []
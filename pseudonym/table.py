@@ -0,0 +1,75 @@
+"""Standalone routing tables for services that only need to route.
+
+A routing table is a small JSON file with, for each alias, its index names
+and sorted routing boundaries. Loading and routing from one only needs
+``pseudonym.strategy``; neither elasticsearch nor a SchemaManager is involved.
+"""
+import json
+import os
+
+from pseudonym.errors import RoutingException
+from pseudonym.strategy import AliasRouter, RangeRouter, DateRangeRouter, write_indexes, write_groups
+
+TABLE_FORMAT = 1
+
+_RANGE_ROUTERS = {'range': RangeRouter, 'date_range': DateRangeRouter}
+
+
+def _load_router(alias_name, exported):
+    if exported['type'] == 'alias':
+        return AliasRouter([], {'name': exported['names'][0]})
+    try:
+        Router = _RANGE_ROUTERS[exported['type']]
+    except KeyError:
+        raise RoutingException("Unknown router type %s for %s." % (exported['type'], alias_name))
+    # Routers take their indexes newest first.
+    indexes = [{'name': name, 'routing': key} for name, key in zip(exported['names'], exported['keys'])]
+    return Router(indexes[::-1], {'name': alias_name})
+
+
+class RoutingTable(object):
+    def __init__(self, routers, version=None, migrations=None):
+        self.routers = routers
+        self.version = version
+        self.migrations = migrations or {}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(dict(snapshot.routers), snapshot.version, dict(snapshot.migrations))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            table = json.load(f)
+        if table.get('format') != TABLE_FORMAT:
+            raise RoutingException("Unsupported routing table format %s in %s." % (table.get('format'), path))
+        routers = {name: _load_router(name, exported) for name, exported in table['aliases'].items()}
+        return cls(routers, table.get('version'), table.get('migrations'))
+
+    def dump(self, path):
+        table = {'format': TABLE_FORMAT,
+                 'version': self.version,
+                 'aliases': {name: router.export() for name, router in self.routers.items()},
+                 'migrations': self.migrations}
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(table, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    def get_router(self, alias_name):
+        try:
+            return self.routers[alias_name]
+        except KeyError:
+            raise RoutingException("%s is not in the routing table." % alias_name)
+
+    def route(self, alias, routing):
+        return self.get_router(alias).route(routing)['name']
+
+    def route_many(self, alias, items, key=None):
+        return self.get_router(alias).route_many(items, key)
+
+    def route_writes(self, alias, routing):
+        return write_indexes(self.route(alias, routing), self.migrations)
+
+    def route_many_writes(self, alias, items, key=None):
+        return write_groups(self.route_many(alias, items, key), self.migrations)
@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allows ``rate`` units per second on average, with bursts up to one second's worth."""
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        """Takes ``amount`` tokens, going into debt if needed, and returns the seconds to wait."""
+        self._refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Throttle(object):
+    """Limits documents and/or bytes per second across every thread using it.
+
+    A rate of None is unlimited. Rates can be changed at any time with
+    ``set_rate``, including while other threads are waiting.
+    """
+    def __init__(self, docs_per_second=None, bytes_per_second=None):
+        self._lock = threading.Lock()
+        self.set_rate(docs_per_second, bytes_per_second)
+
+    def set_rate(self, docs_per_second=None, bytes_per_second=None):
+        with self._lock:
+            self.docs_per_second = docs_per_second
+            self.bytes_per_second = bytes_per_second
+            self._docs = TokenBucket(docs_per_second) if docs_per_second else None
+            self._bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+
+    def scale(self, factor):
+        with self._lock:
+            docs, size = self.docs_per_second, self.bytes_per_second
+        self.set_rate(docs and docs * factor, size and size * factor)
+
+    @property
+    def enabled(self):
+        return self._docs is not None or self._bytes is not None
+
+    def wait(self, docs=1, size=0):
+        with self._lock:
+            now = time.time()
+            delay = 0
+            if self._docs:
+                delay = max(delay, self._docs.take(docs, now))
+            if self._bytes:
+                delay = max(delay, self._bytes.take(size, now))
+        if delay:
+            time.sleep(delay)
@@ -0,0 +1,93 @@
+"""Transform stages for documents streamed through a reindex.
+
+Stages work on scan hits, dicts with ``_id``, ``_type`` and ``_source`` among
+others, and are chained lazily so only a bounded number of documents are in
+memory at once. Stages created with ``in_pool=True`` run in the reindexer's
+process pool when it has one; their functions must then be picklable, i.e.
+defined at module level.
+"""
+import importlib
+from collections import deque
+
+
+class Stage(object):
+    def __init__(self, func, in_pool=False):
+        self.func = func
+        self.in_pool = in_pool
+
+    def __call__(self, hit):
+        """The hits one input hit becomes."""
+        raise NotImplementedError()
+
+    def apply(self, hits):
+        for hit in hits:
+            for out in self(hit):
+                yield out
+
+
+class Filter(Stage):
+    """Keeps the hits ``func`` is true for."""
+    def __call__(self, hit):
+        return [hit] if self.func(hit) else []
+
+
+class Map(Stage):
+    """Replaces each hit with what ``func`` returns, dropping it on None."""
+    def __call__(self, hit):
+        hit = self.func(hit)
+        return [] if hit is None else [hit]
+
+
+class Split(Stage):
+    """Replaces each hit with every hit ``func`` returns for it."""
+    def __call__(self, hit):
+        return list(self.func(hit))
+
+
+def _run_batch(stage, batch):
+    return [out for hit in batch for out in stage(hit)]
+
+
+def _batches(hits, size):
+    batch = []
+    for hit in hits:
+        batch.append(hit)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def pooled(stage, hits, pool, batch_size=100, window=8):
+    """Applies ``stage`` in ``pool``, in order, with at most ``window`` batches in flight."""
+    pending = deque()
+    for batch in _batches(hits, batch_size):
+        pending.append(pool.apply_async(_run_batch, (stage, batch)))
+        if len(pending) >= window:
+            for out in pending.popleft().get():
+                yield out
+    while pending:
+        for out in pending.popleft().get():
+            yield out
+
+
+def pipeline(hits, stages, pool=None, batch_size=100, window=8):
+    """Chains ``stages`` over ``hits``, lazily."""
+    for stage in stages:
+        if pool is not None and stage.in_pool:
+            hits = pooled(stage, hits, pool, batch_size, window)
+        else:
+            hits = stage.apply(hits)
+    return hits
+
+
+def load_stages(path):
+    """The stages named by ``module:attribute``, a stage, a list of them, or a function returning them."""
+    module_name, _, name = path.partition(':')
+    stages = getattr(importlib.import_module(module_name), name)
+    if callable(stages) and not isinstance(stages, Stage):
+        stages = stages()
+    if isinstance(stages, Stage):
+        stages = [stages]
+    return list(stages)
@@ -0,0 +1,29 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaWatcher(threading.Thread):
+    """Polls the schema version in the background and hot-reloads routers.
+
+    Each poll is a source-less GET of the master doc; the schema body is only
+    fetched and compiled when its version moved, see ``SchemaManager.refresh``.
+    """
+    def __init__(self, manager, interval=5):
+        super(SchemaWatcher, self).__init__(name='pseudonym-schema-watcher')
+        self.daemon = True
+        self.manager = manager
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if self.manager.refresh():
+                    logger.info("Reloaded schema version %s" % self.manager.get_current_schema()[0]['_version'])
+            except Exception:
+                logger.exception("Problem polling schema version")
+
+    def stop(self):
+        self._stopped.set()
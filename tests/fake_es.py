@@ -0,0 +1,199 @@
+"""A small in-memory stand-in for the parts of the ES client the reindexer uses."""
+import copy
+import json
+import mock
+import zlib
+
+from elasticsearch.exceptions import NotFoundError
+
+
+def _get_field(source, field):
+    for part in field.split('.'):
+        if not isinstance(source, dict) or part not in source:
+            return None
+        source = source[part]
+    return source
+
+
+def matches(doc, query):
+    if not query or 'match_all' in query:
+        return True
+    if 'term' in query:
+        field, value = query['term'].items()[0]
+        return _get_field(doc['_source'], field) == value
+    if 'exists' in query:
+        return _get_field(doc['_source'], query['exists']['field']) is not None
+    if 'range' in query:
+        field, bounds = query['range'].items()[0]
+        value = _get_field(doc['_source'], field)
+        if value is None:
+            return False
+        return (('gte' not in bounds or value >= bounds['gte']) and ('gt' not in bounds or value > bounds['gt']) and
+                ('lte' not in bounds or value <= bounds['lte']) and ('lt' not in bounds or value < bounds['lt']))
+    if 'ids' in query:
+        return doc['_id'] in query['ids']['values']
+    if 'bool' in query:
+        clauses = query['bool']
+
+        def as_list(key):
+            value = clauses.get(key, [])
+            return value if isinstance(value, list) else [value]
+        if not all(matches(doc, q) for q in as_list('must') + as_list('filter')):
+            return False
+        if any(matches(doc, q) for q in as_list('must_not')):
+            return False
+        should = as_list('should')
+        return not should or any(matches(doc, q) for q in should)
+    raise NotImplementedError(query)
+
+
+class FakeElasticsearch(object):
+    def __init__(self, version='2.3.0'):
+        self.version = version
+        self.docs = {}
+        self.settings = {}
+        self.scrolls = {}
+        self.bulk_calls = []
+        self.indices = mock.Mock()
+        self.indices.put_settings.side_effect = self._put_settings
+        self.indices.exists.side_effect = lambda index: index in self.docs
+        self.indices.create.side_effect = lambda index, body=None, **kwargs: self.docs.setdefault(index, {})
+        self.indices.get_settings.side_effect = self._get_settings
+        self.shards = {}
+        self.transport = mock.Mock()
+        self.transport.serializer.dumps.side_effect = lambda data: data if isinstance(data, basestring) else json.dumps(data)
+        self.transport.serializer.loads.side_effect = json.loads
+        self.transport.perform_request.side_effect = self._perform_request
+        self.reindex_calls = []
+        self.tasks = {}
+        self.cancelled = []
+
+    def add(self, index, docs, doc_type='document'):
+        for i, source in enumerate(docs):
+            self.docs.setdefault(index, {})[str(i)] = {'_index': index, '_type': doc_type, '_id': str(i), '_source': source}
+
+    def _put_settings(self, index, body, **kwargs):
+        for name in index.split(','):
+            self.settings.setdefault(name, []).append(body)
+
+    def _get_settings(self, index, **kwargs):
+        if any(name not in self.docs for name in index.split(',')):
+            raise NotFoundError(404, 'index_not_found_exception')
+        return {name: {'settings': {'index': {'number_of_shards': str(self.shards.get(name, 1))}}}
+                for name in index.split(',')}
+
+    def _perform_request(self, method, url, params=None, body=None):
+        parts = url.strip('/').split('/')
+        if parts == ['_reindex']:
+            self.reindex_calls.append(params)
+            source, dest = body['source']['index'], body['dest']['index']
+            docs = self._query_docs(source, {'query': body['source'].get('query')})
+            for doc in docs:
+                self.docs.setdefault(dest, {})[doc['_id']] = dict(doc, _index=dest)
+            task_id = 'node:%s' % len(self.tasks)
+            # Running for one poll, then done.
+            self.tasks[task_id] = [{'completed': False, 'task': {'status': {'total': len(docs), 'created': 0}}},
+                                   {'completed': True, 'task': {'status': {'total': len(docs), 'created': len(docs)}},
+                                    'response': {'created': len(docs), 'updated': 0, 'failures': []}}]
+            return 200, {'task': task_id}
+        if parts[0] == '_tasks' and parts[-1] == '_cancel':
+            self.cancelled.append(parts[1])
+            self.tasks[parts[1]] = [{'completed': True, 'task': {}, 'error': {'type': 'task_cancelled_exception'}}]
+            return 200, {}
+        if parts[0] == '_tasks':
+            states = self.tasks[parts[1]]
+            return 200, states.pop(0) if len(states) > 1 else states[0]
+        if parts[0] == '_reindex' and parts[-1] == '_rethrottle':
+            self.reindex_calls.append(params)
+            return 200, {}
+        raise NotImplementedError(url)
+
+    def info(self, **kwargs):
+        return {'version': {'number': self.version}}
+
+    def _query_docs(self, index, body):
+        body = body or {}
+        docs = []
+        for name in index.split(','):
+            docs.extend(sorted(self.docs.get(name, {}).values(), key=lambda d: int(d['_id'])))
+        docs = [d for d in docs if matches(d, body.get('query'))]
+        if 'slice' in body:
+            docs = [d for d in docs if zlib.crc32(d['_id']) % body['slice']['max'] == body['slice']['id']]
+        for sort in body.get('sort', []):
+            if isinstance(sort, dict):
+                field = sort.keys()[0]
+                # Docs missing the field sort last, as with ES's default.
+                docs = sorted(docs, key=lambda d: (_get_field(d['_source'], field) is None,
+                                                   _get_field(d['_source'], field)))
+                for d in docs:
+                    d['sort'] = [_get_field(d['_source'], field)]
+        return docs
+
+    def search(self, index=None, body=None, scroll=None, size=10, search_type=None, **kwargs):
+        docs = self._query_docs(index, body)
+        size = (body or {}).get('size', size)
+        if body and 'aggs' in body:
+            aggs = {}
+            for name, agg in body['aggs'].items():
+                kind, cfg = agg.items()[0]
+                values = [_get_field(d['_source'], cfg['field']) for d in docs]
+                values = [v for v in values if v is not None]
+                aggs[name] = {'value': (min if kind == 'min' else max)(values) if values else None}
+            return {'hits': {'total': len(docs), 'hits': []}, 'aggregations': aggs, '_shards': {'failed': 0}}
+        if not scroll:
+            return {'hits': {'total': len(docs), 'hits': [copy.deepcopy(d) for d in docs[:size]]}, '_shards': {'failed': 0}}
+
+        scroll_id = str(len(self.scrolls))
+        pages = [docs[i:i + size] for i in range(0, len(docs), size)]
+        self.scrolls[scroll_id] = pages
+        first = [] if search_type == 'scan' else pages.pop(0) if pages else []
+        return {'_scroll_id': scroll_id, 'hits': {'total': len(docs), 'hits': [copy.deepcopy(d) for d in first]},
+                '_shards': {'failed': 0, 'total': 1}}
+
+    def scroll(self, scroll_id, scroll=None, **kwargs):
+        pages = self.scrolls[scroll_id]
+        page = pages.pop(0) if pages else []
+        return {'_scroll_id': scroll_id, 'hits': {'hits': [copy.deepcopy(d) for d in page]}, '_shards': {'failed': 0, 'total': 1}}
+
+    def clear_scroll(self, *args, **kwargs):
+        pass
+
+    def get(self, index, id, doc_type=None, **kwargs):
+        try:
+            return dict(self.docs[index][id], found=True)
+        except KeyError:
+            raise NotFoundError(404, 'not_found')
+
+    def index(self, index, body, id, doc_type=None, **kwargs):
+        self.docs.setdefault(index, {})[id] = {'_index': index, '_type': doc_type, '_id': id, '_source': json.loads(json.dumps(body))}
+        return {'_id': id, 'created': True}
+
+    def mget(self, body, index=None, **kwargs):
+        docs = []
+        for doc in body['docs']:
+            if doc['_id'] in self.docs.get(index, {}):
+                docs.append(dict(self.docs[index][doc['_id']], found=True))
+            else:
+                docs.append({'_index': index, '_type': doc['_type'], '_id': doc['_id'], 'found': False})
+        return {'docs': docs}
+
+    def count(self, index=None, body=None, **kwargs):
+        if any(name not in self.docs for name in index.split(',')):
+            raise NotFoundError(404, 'index_not_found_exception')
+        return {'count': len(self._query_docs(index, body))}
+
+    def bulk(self, body, **kwargs):
+        lines = [json.loads(line) for line in body.split('\n') if line]
+        self.bulk_calls.append(len(lines) / 2)
+        items = []
+        while lines:
+            action = lines.pop(0)
+            op_type, meta = action.items()[0]
+            source = lines.pop(0)
+            index = self.docs.setdefault(meta['_index'], {})
+            if op_type == 'create' and meta['_id'] in index:
+                items.append({op_type: {'_id': meta['_id'], 'status': 409, 'error': 'document_already_exists_exception'}})
+                continue
+            index[meta['_id']] = {'_index': meta['_index'], '_type': meta['_type'], '_id': meta['_id'], '_source': source}
+            items.append({op_type: {'_id': meta['_id'], 'status': 201}})
+        return {'errors': any(i.values()[0]['status'] >= 300 for i in items), 'items': items}
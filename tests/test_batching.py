@@ -0,0 +1,25 @@
+import unittest
+
+from pseudonym.batching import BatchSizer
+
+
+class TestBatchSizer(unittest.TestCase):
+    def test_grows_while_fast(self):
+        sizer = BatchSizer(docs=100, max_docs=200, target_latency=1)
+        sizer.succeeded(0.1, 100)
+        self.assertEqual(sizer.docs, 125)
+        sizer.succeeded(0.1, 10)
+        self.assertEqual(sizer.docs, 125)
+        for _ in range(10):
+            sizer.succeeded(0.1, sizer.docs)
+        self.assertEqual(sizer.docs, 200)
+
+    def test_backs_off(self):
+        sizer = BatchSizer(docs=100, min_docs=30, target_latency=1)
+        sizer.succeeded(5, 100)
+        self.assertEqual(sizer.docs, 75)
+        self.assertEqual(sizer.rejected(1), 1)
+        self.assertEqual(sizer.docs, 37)
+        self.assertEqual(sizer.rejected(2), 2)
+        self.assertEqual(sizer.docs, 30)
+        self.assertEqual(sizer.scan_size, 30)
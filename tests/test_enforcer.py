@@ -1,6 +1,10 @@
+import mock
+import threading
 import unittest
 from elasticsearch.client import Elasticsearch
+from elasticsearch.exceptions import TransportError
 from pseudonym.enforcer import SchemaEnforcer
+from pseudonym.errors import EnforcementError
 
 
 class TestEnforcer(unittest.TestCase):
@@ -63,3 +67,46 @@ class TestEnforcer(unittest.TestCase):
             index_name = 'test_index_%s' % index_num
             index = self.client.indices.get_settings(index_name)[index_name]
             self.assertEqual(index['settings']['index']['routing'], {'allocation': {'require': {'storage_type': value}}})
+
+
+class TestParallelEnforcer(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        lock = threading.Lock()
+        self.client = mock.Mock()
+
+        def record(method):
+            def call(*args, **kwargs):
+                with lock:
+                    self.calls.append((method, kwargs.get('index') or kwargs.get('name')))
+                if kwargs.get('index') == 'broken':
+                    raise TransportError(500, 'boom')
+                return {}
+            return call
+
+        self.client.indices.put_template.side_effect = record('put_template')
+        self.client.indices.create.side_effect = record('create')
+        for method in ['get_template', 'get_mapping', 'get_alias', 'get_settings']:
+            getattr(self.client.indices, method).return_value = {}
+        self.client.indices.update_aliases.side_effect = record('update_aliases')
+        self.client.indices.put_settings.side_effect = record('put_settings')
+        self.schema = {'templates': {'t%s' % i: {'template': 't%s*' % i} for i in range(5)},
+                       'indexes': [{'name': 'index_%s' % i} for i in range(20)],
+                       'aliases': [{'name': 'alias_%s' % i, 'indexes': ['index_%s' % i]} for i in range(20)],
+                       'settings': [{'indexes': ['index_1'], 'settings': {'index': {'refresh_interval': '5s'}}}]}
+
+    def test_phases(self):
+        SchemaEnforcer(self.client, workers=8).enforce(self.schema)
+        methods = [method for method, _ in self.calls]
+        self.assertEqual(len(methods), 5 + 20 + 1 + 1)
+        last_create = max(i for i, method in enumerate(methods) if method == 'create')
+        first_alias = min(i for i, method in enumerate(methods) if method == 'update_aliases')
+        self.assertLess(last_create, first_alias)
+        self.assertEqual(methods[-1], 'put_settings')
+
+    def test_failures(self):
+        self.schema['indexes'].insert(0, {'name': 'broken'})
+        with self.assertRaises(EnforcementError) as ctx:
+            SchemaEnforcer(self.client, workers=4).enforce(self.schema)
+        self.assertEqual([(kind, name) for kind, name, _ in ctx.exception.failures], [('index', 'broken')])
+        self.assertEqual(len([method for method, _ in self.calls if method == 'update_aliases']), 1)
@@ -1,9 +1,18 @@
 import datetime
 import unittest
 import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 from elasticsearch.client import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
+from pseudonym.errors import RoutingException
 from pseudonym.manager import SchemaManager
+from pseudonym.snapshot import SchemaSnapshot
 
 
 class TestSchemaManager(unittest.TestCase):
@@ -118,3 +127,334 @@ class TestSchemaManager(unittest.TestCase):
         target = self.manager._get_target_index(target)
         self.assertEquals(target, 'assets_2017_01-b')
 
+
+class TestRouterCache(unittest.TestCase):
+    def setUp(self):
+        self.schema = {'aliases': [{'name': name, 'strategy': {'date': {}}, 'indexes': ['%s_201401' % name]}
+                                   for name in ['alias1', 'alias2']],
+                       'indexes': [{'name': '%s_201401' % name, 'alias': name, 'routing': '2014-01-01T00:00:00'}
+                                   for name in ['alias1', 'alias2']]}
+        self.version = 1
+        self.client = mock.Mock()
+        self.client.get.side_effect = lambda **kwargs: {'_version': self.version, '_source': {'schema': json.dumps(self.schema)}}
+        self.manager = SchemaManager(self.client)
+
+    def add_index(self, alias_num, name, routing):
+        alias = self.schema['aliases'][alias_num]
+        self.schema['indexes'].append({'name': name, 'alias': alias['name'], 'routing': routing})
+        alias['indexes'].append(name)
+        self.version += 1
+
+    def test_retains_unchanged_routers(self):
+        router1 = self.manager.get_router('alias1')
+        router2 = self.manager.get_router('alias2')
+
+        self.add_index(1, 'alias2_201402', '2014-02-01T00:00:00')
+        self.manager.reload()
+
+        self.assertIs(self.manager.get_router('alias1'), router1)
+        self.assertIsNot(self.manager.get_router('alias2'), router2)
+        self.assertEqual(self.manager.route('alias2', datetime.datetime(2014, 3, 1)), 'alias2_201402')
+
+    def test_apply(self):
+        router1 = self.manager.get_router('alias1')
+        meta, schema = self.manager.get_current_schema(True)
+        schema['indexes'].append({'name': 'alias1_201402', 'alias': 'alias1', 'routing': '2014-02-01T00:00:00'})
+        schema['aliases'][0]['indexes'].append('alias1_201402')
+        self.manager.apply(meta, schema)
+
+        self.assertIsNot(self.manager.get_router('alias1'), router1)
+        self.assertEqual(self.manager.route('alias1', datetime.datetime(2014, 3, 1)), 'alias1_201402')
+
+    def test_refresh(self):
+        router1 = self.manager.get_router('alias1')
+        self.assertFalse(self.manager.refresh())
+        self.assertIs(self.manager.get_router('alias1'), router1)
+
+        self.add_index(1, 'alias2_201402', '2014-02-01T00:00:00')
+        self.assertTrue(self.manager.refresh())
+        self.assertEqual(self.manager.get_current_schema()[0]['_version'], 2)
+        self.assertIs(self.manager.get_router('alias1'), router1)
+        self.assertEqual(self.manager.route('alias2', datetime.datetime(2014, 3, 1)), 'alias2_201402')
+
+    def test_route_writes(self):
+        self.assertEqual(self.manager.route_writes('alias1', datetime.datetime(2015, 1, 1)), ['alias1_201401'])
+        self.schema['migrations'] = {'alias1_201401': 'alias1_201401-a'}
+        self.version += 1
+        self.manager.refresh()
+        self.assertEqual(self.manager.route_writes('alias1', datetime.datetime(2015, 1, 1)),
+                         ['alias1_201401', 'alias1_201401-a'])
+        self.assertEqual(self.manager.route_many_writes('alias1', [datetime.datetime(2015, 1, 1)]),
+                         {'alias1_201401': [datetime.datetime(2015, 1, 1)],
+                          'alias1_201401-a': [datetime.datetime(2015, 1, 1)]})
+        self.assertEqual(self.manager.route_writes('alias2', datetime.datetime(2015, 1, 1)), ['alias2_201401'])
+
+    def test_broken_alias(self):
+        self.add_index(1, 'alias2_201402', 'February')
+        self.schema['aliases'].append({'name': 'alias3', 'strategy': 'date', 'indexes': []})
+        self.manager.reload()
+        self.assertEqual(self.manager.route('alias1', datetime.datetime(2015, 1, 1)), 'alias1_201401')
+        self.assertRaises(RoutingException, self.manager.route, 'alias2', datetime.datetime(2015, 1, 1))
+        self.assertRaises(RoutingException, self.manager.route, 'alias3', datetime.datetime(2015, 1, 1))
+        self.assertEqual(self.manager.get_current_schema()[0]['_version'], 2)
+
+    def test_watch(self):
+        self.manager.get_router('alias2')
+        watcher = self.manager.watch(0.01)
+        try:
+            self.add_index(1, 'alias2_201402', '2014-02-01T00:00:00')
+            for _ in range(100):
+                if self.manager.route('alias2', datetime.datetime(2014, 3, 1)) == 'alias2_201402':
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.manager.route('alias2', datetime.datetime(2014, 3, 1)), 'alias2_201402')
+        finally:
+            self.manager.stop_watching()
+        watcher.join(1)
+        self.assertFalse(watcher.is_alive())
+
+    def test_concurrent_routing(self):
+        expected = {'alias1_201401'}
+        errors = []
+        done = threading.Event()
+
+        def route():
+            try:
+                while not done.is_set():
+                    self.assertIn(self.manager.route('alias1', datetime.datetime(2015, 1, 1)), expected)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=route) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for month in range(2, 13):
+            name = 'alias1_2014%02d' % month
+            expected.add(name)
+            self.add_index(0, name, '2014-%02d-01T00:00:00' % month)
+            self.manager.refresh()
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.manager.route('alias1', datetime.datetime(2015, 1, 1)), 'alias1_201412')
+
+
+class TestLocalSnapshot(TestRouterCache):
+    def setUp(self):
+        super(TestLocalSnapshot, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.tmp_dir, 'schema.snapshot')
+        self.manager = SchemaManager(self.client, snapshot_path=self.snapshot_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_startup_from_snapshot(self):
+        self.manager.get_current_schema()
+        self.assertTrue(os.path.exists(self.snapshot_path))
+
+        self.client.get.reset_mock()
+        polled = threading.Event()
+
+        def get(**kwargs):
+            polled.set()
+            return {'_version': self.version}
+        self.client.get.side_effect = get
+
+        manager = SchemaManager(self.client, snapshot_path=self.snapshot_path)
+        self.assertEqual(manager.route('alias1', datetime.datetime(2015, 1, 1)), 'alias1_201401')
+        self.assertEqual(manager.snapshot.version, 1)
+        self.assertTrue(polled.wait(1))
+        for call in self.client.get.call_args_list:
+            self.assertEqual(call[1].get('_source'), False)
+
+    def test_keeps_newer_snapshot(self):
+        self.assertTrue(SchemaSnapshot({'_version': 2}, self.schema).dump(self.snapshot_path))
+        self.assertFalse(SchemaSnapshot({'_version': 1}, self.schema).dump(self.snapshot_path))
+        self.assertEqual(SchemaSnapshot.load(self.snapshot_path).version, 2)
+        self.assertEqual(os.listdir(self.tmp_dir), ['schema.snapshot'])
+
+    def test_concurrent_dumps(self):
+        errors = []
+
+        def dump(version):
+            try:
+                for _ in range(20):
+                    SchemaSnapshot({'_version': version}, self.schema).dump(self.snapshot_path)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=dump, args=(version,)) for version in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.tmp_dir), ['schema.snapshot'])
+        self.assertIsNotNone(SchemaSnapshot.load(self.snapshot_path))
+
+    def test_unreadable_snapshot(self):
+        with open(self.snapshot_path, 'w') as f:
+            f.write('garbage')
+        self.assertEqual(self.manager.route('alias1', datetime.datetime(2015, 1, 1)), 'alias1_201401')
+
+
+class TestEnforceDelta(unittest.TestCase):
+    def setUp(self):
+        self.docs = {}
+        self.client = mock.Mock()
+
+        def get(index, id, **kwargs):
+            if id not in self.docs:
+                raise NotFoundError(404, 'not found')
+            return json.loads(json.dumps(self.docs[id]))
+
+        def index(index, id, body, doc_type=None, **kwargs):
+            self.docs[str(id)] = {'_version': kwargs.get('version'), '_source': body}
+        self.client.get.side_effect = get
+        self.client.index.side_effect = index
+        self.client.create.side_effect = index
+        for method in ['get_template', 'get_mapping', 'get_alias', 'get_settings']:
+            getattr(self.client.indices, method).return_value = {}
+        self.manager = SchemaManager(self.client)
+        self.manager.apply({'_version': 0}, {'templates': {}, 'settings': [], 'indexes': [{'name': 'index_1'}],
+                                             'aliases': [{'name': 'alias1', 'indexes': ['index_1'],
+                                                          'strategy': {'appending_pointer': {'aliases': ['alias1']}}}]})
+
+    def test(self):
+        self.manager.enforce()
+        self.assertEqual(self.docs['enforced']['_source'], {'version': 1})
+        self.assertEqual(self.client.indices.get_settings.call_count, 1)
+        self.assertEqual(self.client.indices.create.call_count, 1)
+
+        self.manager.add_index('alias1', 'index_2')
+        self.client.indices.reset_mock()
+        self.manager.enforce()
+        self.assertEqual(self.docs['enforced']['_source'], {'version': 2})
+        self.assertEqual(self.client.indices.get_settings.call_count, 0)
+        self.assertEqual([c[1]['index'] for c in self.client.indices.create.call_args_list], ['index_2'])
+        self.assertEqual(self.client.indices.update_aliases.call_args[0][0],
+                         {'actions': [{'add': {'index': 'index_2', 'alias': 'alias1'}}]})
+
+        self.client.indices.reset_mock()
+        self.manager.enforce(full=True)
+        self.assertEqual(self.client.indices.get_settings.call_count, 1)
+
+
+class TestBulkLoad(TestEnforceDelta):
+    def setUp(self):
+        super(TestBulkLoad, self).setUp()
+        self.client.indices.get_settings.side_effect = lambda **kwargs: {
+            'index_1': {'settings': {'index': {'number_of_replicas': '2'}}}}
+        self.manager.bulk_load_settings['translog.durability'] = 'async'
+
+    def test(self):
+        self.manager.start_bulk_load('index_1')
+        load = {'index.refresh_interval': '-1', 'index.number_of_replicas': 0, 'index.translog.durability': 'async'}
+        self.client.indices.put_settings.assert_called_once_with(index='index_1', body=load)
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['bulk_load']['index_1']['restore'], {
+            'index.refresh_interval': '1s', 'index.number_of_replicas': '2', 'index.translog.durability': 'request'})
+
+        # Enforcing leaves the load settings alone.
+        self.client.indices.get_settings.side_effect = lambda **kwargs: {
+            'index_1': {'settings': {'index': {'number_of_replicas': '0', 'refresh_interval': '-1',
+                                               'translog': {'durability': 'async'}}}}}
+        self.assertEqual(dict(self.manager.plan_enforcement(full=True).phases)['settings'], [])
+
+        self.client.indices.reset_mock()
+        self.manager.finish_bulk_load('index_1')
+        self.client.indices.put_settings.assert_called_once_with(index='index_1', body={
+            'index.refresh_interval': '1s', 'index.number_of_replicas': '2', 'index.translog.durability': 'request'})
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['bulk_load'], {})
+
+
+    def test_remove_index(self):
+        self.manager.start_bulk_load('index_1')
+        self.manager.remove_index('index_1')
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['bulk_load'], {})
+        self.client.indices.reset_mock()
+        self.manager.enforce(full=True)
+        self.assertFalse(self.client.indices.put_settings.called)
+
+
+class TestCutoverVerification(TestEnforceDelta):
+    def test_refuses_short_target(self):
+        self.manager.reindexer.verify = mock.Mock(return_value=[
+            {'partition': 0, 'source': 10, 'target': 10, 'sample': None, 'ok': True},
+            {'partition': 1, 'source': 10, 'target': 9, 'sample': None, 'ok': False}])
+        self.manager.reindex_cutover('index_1')
+        self.manager.reindexer.verify.assert_called_once_with('index_1', 'index_1-a', 0)
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['aliases'][0]['indexes'], ['index_1'])
+        self.assertFalse(self.client.indices.update_aliases.called)
+
+    def test_online_reindex_cuts_over_before_unblocking(self):
+        calls = []
+        self.client.indices.exists.return_value = True
+        self.client.indices.get_settings.return_value = {}
+        self.manager.reindexer = mock.Mock()
+        self.manager.reindexer.do_reindex.return_value = True
+        self.manager.reindexer.set_write_block.side_effect = lambda index, block: calls.append(('block', block))
+        self.manager.reindex_cutover = lambda index, sample_size: calls.append(('cutover', index))
+        self.manager.reindex('index_1', online=True)
+        self.assertEqual(self.manager.reindexer.do_reindex.call_args[0][4:], (True, False))
+        self.assertEqual(calls, [('cutover', 'index_1'), ('block', False)])
+
+    def test_migration_ends_at_cutover(self):
+        meta, schema = self.manager.get_current_schema(True)
+        schema['indexes'][0]['alias'] = 'alias1'
+        self.manager.apply(meta, schema)
+        self.manager.start_migration('index_1', 'index_1-a')
+        self.assertEqual(self.manager.snapshot.migrations, {'index_1': 'index_1-a'})
+        self.manager.reindexer.verify = mock.Mock(return_value=[
+            {'partition': 0, 'source': 10, 'target': 10, 'sample': None, 'ok': True}])
+        self.manager.reindex_cutover('index_1')
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['migrations'], {})
+        self.assertEqual(schema['aliases'][0]['indexes'], ['index_1-a'])
+
+    def test_dual_write_waits_for_producers(self):
+        calls = []
+        self.client.indices.exists.return_value = True
+        self.client.indices.get_settings.return_value = {}
+        self.manager.reindexer = mock.Mock()
+        self.manager.reindexer.do_reindex.side_effect = lambda *args: calls.append(
+            ('copy', dict(self.manager.snapshot.migrations)))
+        with mock.patch('pseudonym.manager.time') as manager_time:
+            manager_time.sleep.side_effect = lambda seconds: calls.append(('sleep', seconds))
+            self.manager.reindex('index_1', dual_write=True)
+        self.assertEqual(calls, [('sleep', 5), ('copy', {'index_1': 'index_1-a'})])
+
+        # Already recorded when resuming, so producers have seen it.
+        del calls[:]
+        with mock.patch('pseudonym.manager.time') as manager_time:
+            manager_time.sleep.side_effect = lambda seconds: calls.append(('sleep', seconds))
+            self.manager.reindex('index_1', resume=True, dual_write=True)
+        self.assertEqual(calls, [('copy', {'index_1': 'index_1-a'})])
+
+    def test_failed_cutover_reports_migration(self):
+        # Not in an alias, so the cutover doesn't remove it and its migration.
+        meta, schema = self.manager.get_current_schema(True)
+        schema['aliases'][0]['indexes'] = []
+        self.manager.apply(meta, schema)
+        self.manager.start_migration('index_1', 'index_1-a')
+        self.manager.reindexer.verify = mock.Mock(return_value=[])
+        self.manager.verify_cutover = mock.Mock(return_value=False)
+        with mock.patch('pseudonym.manager.logger') as logger:
+            self.assertFalse(self.manager.reindex_cutover('index_1'))
+        self.assertIn('finish_migration', logger.error.call_args[0][0])
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['migrations'], {'index_1': 'index_1-a'})
+
+    def test_remove_index_ends_migrations(self):
+        self.manager.start_migration('index_1', 'index_1-a')
+        self.manager.start_migration('index_2', 'index_2-a')
+        self.manager.remove_index('index_1-a')
+        self.manager.remove_index('index_2')
+        _, schema = self.manager.get_current_schema(True)
+        self.assertEqual(schema['migrations'], {})
+        self.assertEqual(self.manager.snapshot.migrations, {})
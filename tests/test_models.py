@@ -0,0 +1,65 @@
+import copy
+import pickle
+import unittest
+from pseudonym.models import Index, IndexRecord, Schema
+
+
+class TestIndexRecord(unittest.TestCase):
+    def test_round_trip(self):
+        cfg = {'name': 'i1', 'alias': 'a', 'routing': 5, 'mappings': None, 'owner': 'team'}
+        record = IndexRecord.from_dict(cfg)
+        self.assertEqual(record.to_dict(), cfg)
+        self.assertEqual(record.index, Index('i1', 'a', 5))
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+
+    def test_reads_like_dict(self):
+        record = IndexRecord.from_dict({'name': 'i1', 'alias': 'a', 'owner': 'team'})
+        self.assertEqual(record['name'], 'i1')
+        self.assertEqual(record['owner'], 'team')
+        self.assertRaises(KeyError, lambda: record['routing'])
+        self.assertIsNone(record.get('routing'))
+        self.assertNotIn('routing', record)
+        self.assertIn('owner', record)
+        self.assertEqual(record[0], 'i1')
+        self.assertRaises(AttributeError, setattr, record, 'owner', 'other')
+
+    def test_replace(self):
+        record = IndexRecord.from_dict({'name': 'i1'}).replace(routing=3)
+        self.assertEqual(record['routing'], 3)
+        self.assertEqual(record.to_dict(), {'name': 'i1', 'routing': 3})
+
+    def test_shares_absent_fields(self):
+        first = IndexRecord.from_dict({'name': 'i1', 'alias': 'a'})
+        second = IndexRecord.from_dict({'name': 'i2', 'alias': 'b'})
+        self.assertIs(first.absent, second.absent)
+
+
+class TestSchema(unittest.TestCase):
+    def setUp(self):
+        self.json = {'aliases': [{'name': 'a', 'indexes': ['i2', 'i1']}],
+                     'indexes': [{'name': 'i1', 'alias': 'a', 'routing': 1},
+                                 {'name': 'i2', 'alias': 'a', 'routing': 2},
+                                 {'name': 'i3', 'alias': 'b'}],
+                     'templates': {}, 'settings': [], 'migrations': {'i1': 'i1-a'}}
+
+    def test_round_trip(self):
+        self.assertEqual(Schema.from_json(copy.deepcopy(self.json)).to_json(), self.json)
+
+    def test_lookups(self):
+        schema = Schema.from_json(self.json)
+        self.assertEqual(schema.indexes['i2']['routing'], 2)
+        self.assertIs(schema.aliases['a'], self.json['aliases'][0])
+        self.assertEqual([i.name for i in schema.in_order(['i3', 'i1', 'missing'])], ['i1', 'i3'])
+        self.assertEqual([i.name for i in schema.indexes_of(['a', 'c'])], ['i1', 'i2'])
+        self.assertIs(Schema.of(schema), schema)
+
+    def test_add_and_remove(self):
+        schema = Schema.from_json(self.json)
+        schema.remove_index('i1')
+        schema.add_index({'name': 'i1', 'alias': 'b'})
+        self.assertEqual([i.name for i in schema.indexes_of(['a'])], ['i2'])
+        self.assertEqual([i.name for i in schema.indexes_of(['b'])], ['i3', 'i1'])
+
+        schema.replace_index('i3', alias='a')
+        self.assertEqual([i.name for i in schema.indexes_of(['a'])], ['i2', 'i3'])
+        self.assertEqual([i['name'] for i in schema.to_json()['indexes']], ['i2', 'i3', 'i1'])
@@ -0,0 +1,87 @@
+import unittest
+
+from pseudonym.plan import ClusterState, EnforcementPlan
+
+
+class TestEnforcementPlan(unittest.TestCase):
+    def setUp(self):
+        mapping = {'properties': {'field1': {'type': 'string', 'index': 'not_analyzed'}}}
+        self.schema = {'templates': {'t1': {'template': 'test_*', 'settings': {'number_of_shards': 1}, 'mappings': {'doc': mapping}}},
+                       'indexes': [{'name': 'test_1', 'mappings': {'doc': mapping}}, {'name': 'test_2'}],
+                       'aliases': [{'name': 'alias1', 'indexes': ['test_1', 'test_2'], 'routing': None, 'filter': None},
+                                   {'name': 'alias2', 'indexes': ['test_2'], 'routing': 'r', 'filter': {'term': {'field1': 'a'}}}],
+                       'settings': [{'indexes': ['test_1', 'test_2'], 'settings': {'index': {'refresh_interval': '5s', 'blocks': {'write': False}}}}]}
+        cluster_mapping = {'properties': {'field1': {'type': 'string', 'index': 'not_analyzed'}, 'field2': {'type': 'long'}}}
+        self.state = ClusterState(
+            templates={'t1': {'order': 0, 'template': 'test_*', 'settings': {'index': {'number_of_shards': '1'}},
+                              'mappings': {'doc': mapping}, 'aliases': {}}},
+            mappings={'test_1': {'doc': cluster_mapping}, 'test_2': {}},
+            aliases={'alias1': {'test_1': {}, 'test_2': {}},
+                     'alias2': {'test_2': {'index_routing': 'r', 'search_routing': 'r', 'filter': {'term': {'field1': 'a'}}}}},
+            settings={index: {'index.refresh_interval': '5s', 'index.blocks.write': 'false', 'index.number_of_shards': '5'}
+                      for index in ['test_1', 'test_2']})
+
+    def test_steady_state(self):
+        plan = EnforcementPlan.build(self.schema, self.state)
+        self.assertEqual(len(plan), 0)
+        self.assertEqual(plan.describe(), [])
+
+    def test_diff(self):
+        self.schema['templates']['t1']['settings']['number_of_shards'] = 2
+        self.schema['indexes'].append({'name': 'test_3'})
+        self.schema['indexes'][0]['mappings']['doc']['properties']['field3'] = {'type': 'long'}
+        self.schema['aliases'][0]['indexes'] = ['test_1', 'test_3']
+        self.schema['aliases'][1]['routing'] = 's'
+        self.schema['settings'][0]['indexes'].append('test_3')
+        self.state.settings['test_2']['index.refresh_interval'] = '1s'
+
+        plan = EnforcementPlan.build(self.schema, self.state)
+        phases = dict(plan.phases)
+        self.assertEqual([a.name for a in phases['templates']], ['t1'])
+        self.assertEqual([a.name for a in phases['indexes']], ['test_3'])
+        self.assertEqual([a.name for a in phases['mappings']], ['test_1/doc'])
+        self.assertEqual({a.name: a.args[0]['actions'] for a in phases['aliases']},
+                         {'alias1,alias2': [{'add': {'index': 'test_3', 'alias': 'alias1', 'routing': None, 'filter': None}},
+                                            {'remove': {'index': 'test_2', 'alias': 'alias1'}},
+                                            {'add': {'index': 'test_2', 'alias': 'alias2', 'routing': 's', 'filter': {'term': {'field1': 'a'}}}}]})
+        self.assertEqual(sorted(a.args for a in phases['settings']),
+                         [(['test_2'], {'index.refresh_interval': '5s'}),
+                          (['test_3'], {'index.refresh_interval': '5s', 'index.blocks.write': False})])
+        self.assertEqual(len(plan.describe()), 6)
+
+    def test_alias_chunks(self):
+        self.schema['aliases'] = [{'name': 'new%s' % i, 'indexes': ['test_1', 'test_2']} for i in range(5)]
+        plan = EnforcementPlan.build(self.schema, self.state, alias_chunk_size=5)
+        chunks = [a for a in plan.actions if a.kind == 'alias']
+        self.assertEqual([a.name for a in chunks], ['new0,new1', 'new2,new3', 'new4'])
+        self.assertEqual([len(a.args[0]['actions']) for a in chunks], [4, 4, 2])
+
+    def test_settings_coalesced(self):
+        self.state.settings = {}
+        indexes = ['index_%03d' % i for i in range(100)]
+        self.schema['settings'] = [{'indexes': indexes[:50], 'settings': {'index': {'refresh_interval': '5s'}}},
+                                   {'indexes': indexes[50:], 'settings': {'refresh_interval': '5s'}},
+                                   {'indexes': indexes[:10], 'settings': {'index': {'refresh_interval': '30s'}}}]
+        plan = EnforcementPlan.build(self.schema, self.state, max_index_list_length=200)
+        actions = [a for a in plan.actions if a.kind == 'settings']
+        self.assertEqual([a.args[1] for a in actions if a.args[0][0] == 'index_000'], [{'index.refresh_interval': '30s'}])
+        by_body = {}
+        for action in actions:
+            self.assertLessEqual(len(action.name), 200)
+            by_body.setdefault(action.args[1]['index.refresh_interval'], []).extend(action.args[0])
+        self.assertEqual(by_body, {'30s': indexes[:10], '5s': indexes[10:]})
+
+    def test_delta(self):
+        old = {'templates': {'t1': {'template': 'test_*'}},
+               'indexes': [{'name': 'test_1'}],
+               'aliases': [{'name': 'alias1', 'indexes': ['test_1'], 'routing': None, 'filter': None}],
+               'settings': [{'indexes': ['test_1'], 'settings': {'index': {'refresh_interval': '5s'}}}]}
+        self.assertEqual(len(EnforcementPlan.build(old, ClusterState.from_schema(old))), 0)
+
+        new = {'templates': {'t1': {'template': 'test_*'}},
+               'indexes': [{'name': 'test_1'}, {'name': 'test_2'}],
+               'aliases': [{'name': 'alias1', 'indexes': ['test_2'], 'routing': None, 'filter': None}],
+               'settings': [{'indexes': ['test_1', 'test_2'], 'settings': {'index': {'refresh_interval': '5s'}}}]}
+        plan = EnforcementPlan.build(new, ClusterState.from_schema(old))
+        self.assertEqual([(a.kind, a.name) for a in plan.actions],
+                         [('index', 'test_2'), ('alias', 'alias1'), ('settings', 'test_2')])
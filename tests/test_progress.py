@@ -0,0 +1,33 @@
+import unittest
+
+from pseudonym.progress import ReindexProgress, percentile
+
+
+class TestReindexProgress(unittest.TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 51)
+        self.assertEqual(percentile(values, 99), 100)
+        self.assertIsNone(percentile([], 50))
+
+    def test_eta(self):
+        progress = ReindexProgress(total=1000)
+        progress.started -= 10
+        progress.add_scanned(300)
+        progress.add_bulk(0.2, 190, 10, 4096)
+        progress.add_retry()
+        stats = progress.stats()
+        self.assertAlmostEqual(stats['docs_per_second'], 20, 0)
+        self.assertAlmostEqual(stats['eta'], 40, 0)
+        self.assertEqual((stats['scanned'], stats['written'], stats['failed'], stats['retries'], stats['bytes']),
+                         (300, 190, 10, 1, 4096))
+        self.assertIn('eta 40s', ReindexProgress.describe(stats))
+
+        progress.finish()
+        self.assertTrue(progress.stats()['done'])
+        self.assertIn('took', ReindexProgress.describe(progress.stats()))
+
+    def test_unknown_total(self):
+        progress = ReindexProgress()
+        progress.add_bulk(0.1, 10, 0, 100)
+        self.assertIsNone(progress.stats()['eta'])
@@ -1,8 +1,20 @@
+import json
+import mock
+import os
+import signal
+import threading
+import time
 import unittest
 from elasticsearch.client import Elasticsearch
+from elasticsearch.exceptions import TransportError
+from pseudonym.batching import BatchSizer
+from pseudonym.checkpoint import ReindexCheckpoint
+from pseudonym.errors import InvalidConfigError
+from pseudonym.transform import Filter, Map
 from pseudonym.reindexer import Reindexer
 from pseudonym.manager import SchemaManager
 from elasticsearch.helpers import bulk
+from tests.fake_es import FakeElasticsearch
 
 class TestReindexer(unittest.TestCase):
     def setUp(self):
@@ -50,3 +62,415 @@ class TestReindexer(unittest.TestCase):
         self.assertEqual(len(docs['hits']['hits']), 5)
 
 
+def _raise(e):
+    raise e
+
+
+def _has_ts(hit):
+    return 'ts' in hit['_source']
+
+
+def _rename_ts(hit):
+    hit['_source']['timestamp'] = hit['_source'].pop('ts')
+    return hit
+
+
+class TestParallelReindexer(unittest.TestCase):
+    def setUp(self):
+        self.docs = [{'name': str(i), 'ts': i * 10} for i in range(100)] + [{'name': 'no_ts'}]
+
+    def assert_copied(self, client):
+        self.assertEqual(sorted(d['_source']['name'] for d in client.docs['target'].values()),
+                         sorted(d['name'] for d in self.docs))
+        self.assertEqual(client.settings['source'], [{'index': {'blocks': {'write': True}}},
+                                                     {'index': {'blocks': {'write': False}}}])
+
+    def test_sliced_scroll(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=4)
+        reindexer.native = False
+        self.assertEqual(len(reindexer._partitions('source')), 4)
+        reindexer.do_reindex('source', 'target', 0)
+        self.assert_copied(client)
+
+    def test_field_ranges(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=3, slice_field='ts')
+        partitions = reindexer._partitions('source')
+        self.assertEqual(len(partitions), 3)
+        self.assertEqual(sorted(len(client._query_docs('source', p)) for p in partitions), [33, 34, 34])
+        reindexer.do_reindex('source', 'target', 0)
+        self.assert_copied(client)
+
+    def test_single(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=3)
+        self.assertEqual(reindexer._partitions('source'), [None])
+        reindexer.do_reindex('source', 'target', 0)
+        self.assert_copied(client)
+
+    def test_throttle(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        scroll = client.scroll
+        reindexer = Reindexer(client, workers=2)
+        reindexer.native = False
+        reindexer.throttle.set_rate(docs_per_second=60)
+        start = time.time()
+        reindexer.do_reindex('source', 'target')
+        self.assertGreaterEqual(time.time() - start, 0.45)
+        self.assertEqual(client.scroll, scroll)
+        self.assert_copied(client)
+
+    def test_no_sleep(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client)
+        # As the CLI passes it, 0 means no pause between pages.
+        self.assertTrue(reindexer.do_reindex('source', 'target', '0'))
+        self.assertFalse(reindexer.throttle.enabled)
+        self.assert_copied(client)
+
+    def test_signal_during_copy(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=2)
+        reindexer.native = False
+        reindexer.throttle.set_rate(docs_per_second=1000)
+        handled = threading.Event()
+        in_time = []
+
+        def handler(*_):
+            reindexer.throttle.scale(2)
+            handled.set()
+        bulk = client.bulk
+
+        def signalling_bulk(body, **kwargs):
+            if not handled.is_set():
+                os.kill(os.getpid(), signal.SIGUSR1)
+                # Handled by the main thread while the partitions are still copying.
+                in_time.append(handled.wait(2))
+            return bulk(body)
+        client.bulk = signalling_bulk
+
+        previous = signal.signal(signal.SIGUSR1, handler)
+        try:
+            reindexer.do_reindex('source', 'target')
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        self.assertTrue(in_time and all(in_time))
+        self.assertEqual(reindexer.throttle.docs_per_second, 2000)
+        self.assert_copied(client)
+
+    def test_stop(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client)
+        reindexer.stop()
+        self.assertFalse(reindexer.do_reindex('source', 'target'))
+        self.assertEqual(client.bulk_calls, [])
+        self.assertEqual(client.settings['source'][-1], {'index': {'blocks': {'write': False}}})
+
+    def test_rejections(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        bulk = client.bulk
+        rejections = [2]
+
+        def rejecting_bulk(body, **kwargs):
+            if rejections[0]:
+                rejections[0] -= 1
+                resp = bulk(body)
+                for item in resp['items'][::2]:
+                    client.docs['target'].pop(item['index']['_id'])
+                    item['index'].update({'status': 429, 'error': {'type': 'es_rejected_execution_exception'}})
+                return resp
+            return bulk(body)
+        client.bulk = rejecting_bulk
+
+        reindexer = Reindexer(client)
+        reindexer.native = False
+        reindexer.sizer.rejected = lambda attempt: 0
+        reindexer.do_reindex('source', 'target')
+        self.assert_copied(client)
+        self.assertEqual(client.bulk_calls, [101, 51, 26])
+
+    def test_native(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=4)
+        reindexer.poll_interval = 0
+        reindexer.throttle.set_rate(docs_per_second=500)
+        self.assertTrue(reindexer.use_native())
+        response = reindexer._native_reindex('source', 'target')
+        self.assertEqual(response['created'], 101)
+        self.assertEqual(client.reindex_calls, [{'wait_for_completion': 'false', 'slices': 4, 'requests_per_second': 500}])
+        self.assertEqual(client.bulk_calls, [])
+        self.assertEqual(reindexer.progress.stats()['written'], 101)
+
+    def test_progress(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client)
+        reindexer.sizer = BatchSizer(docs=50, min_docs=50, max_docs=50)
+        reindexer.progress_interval = 0
+        reports = []
+        reindexer.callbacks.append(reports.append)
+        reindexer.do_reindex('source', 'target')
+
+        self.assertEqual([(r['written'], r['done']) for r in reports], [(50, False), (100, False), (101, False),
+                                                                         (101, True)])
+        final = reports[-1]
+        self.assertEqual((final['total'], final['scanned'], final['failed'], final['requests']), (101, 101, 0, 3))
+        self.assertEqual(final['eta'], 0)
+        self.assertGreater(final['bytes'], 0)
+        self.assertIsNotNone(final['latency']['p99'])
+
+    def test_transforms(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=2)
+        reindexer.transforms = [Filter(_has_ts), Map(_rename_ts, in_pool=True)]
+        reindexer.transform_processes = 2
+        self.assertFalse(reindexer.use_native())
+        reindexer.do_reindex('source', 'target')
+        self.assertEqual(sorted(d['_source']['timestamp'] for d in client.docs['target'].values()),
+                         [i * 10 for i in range(100)])
+        self.assertEqual(reindexer.progress.stats()['scanned'], 101)
+        self.assertEqual(reindexer.progress.stats()['written'], 100)
+
+    def test_transform_pool_before_threads(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=2)
+        reindexer.transforms = [Filter(_has_ts), Map(_rename_ts, in_pool=True)]
+        reindexer.transform_processes = 2
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        try:
+            self.assertRaises(InvalidConfigError, reindexer.start_transform_pool)
+            self.assertFalse(reindexer.do_reindex('source', 'target'))
+            self.assertEqual(client.bulk_calls, [])
+        finally:
+            release.set()
+            thread.join()
+
+        pool = reindexer.start_transform_pool()
+        release.clear()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        try:
+            self.assertTrue(reindexer.clone().do_reindex('source', 'target'))
+            self.assertIs(reindexer._process_pool, pool)
+        finally:
+            release.set()
+            thread.join()
+            reindexer.stop_transform_pool()
+        self.assertEqual(len(client.docs['target']), 100)
+
+    def test_online(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        bulk = client.bulk
+        blocked = []
+
+        def writing_bulk(body, **kwargs):
+            blocked.append(len(client.settings.get('source', [])))
+            if len(client.bulk_calls) == 0:
+                # Written to the source while it's being copied.
+                client.docs['source']['5']['_source'] = {'name': 'updated', 'ts': 2000}
+                client.docs['source']['200'] = {'_index': 'source', '_type': 'document', '_id': '200',
+                                                '_source': {'name': 'new', 'ts': 2001}}
+            return bulk(body)
+        client.bulk = writing_bulk
+
+        reindexer = Reindexer(client)
+        reindexer.changed_field = 'ts'
+        reindexer.catch_up_threshold = 1
+        self.assertTrue(reindexer.do_reindex('source', 'target', online=True))
+        self.assertEqual(client.docs['target']['5']['_source']['name'], 'updated')
+        self.assertEqual(client.docs['target']['200']['_source']['name'], 'new')
+        # The copy and a catch up pass with writes allowed, the last one blocked and left blocked.
+        self.assertEqual(client.bulk_calls, [101, 3, 1])
+        self.assertEqual(blocked, [0, 0, 1])
+        self.assertEqual(client.settings['source'], [{'index': {'blocks': {'write': True}}}])
+
+    def test_online_needs_field(self):
+        self.assertRaises(InvalidConfigError, Reindexer(FakeElasticsearch()).do_reindex, 'source', 'target',
+                          online=True)
+
+    def test_dual_write(self):
+        for version in ['2.3.0', '5.1.1']:
+            client = FakeElasticsearch(version=version)
+            client.add('source', self.docs)
+            # Written to both by a producer since the copy started.
+            client.docs['source']['3']['_source'] = {'name': 'newer'}
+            client.docs['target'] = {'3': dict(client.docs['source']['3'], _index='target')}
+            client.docs['source']['3']['_source'] = {'name': 'older'}
+            reindexer = Reindexer(client)
+            reindexer.native = False
+            self.assertTrue(reindexer.do_reindex('source', 'target', dual_write=True))
+            self.assertEqual(client.docs['target']['3']['_source'], {'name': 'newer'})
+            self.assertEqual(len(client.docs['target']), 101)
+            self.assertEqual(reindexer.progress.stats()['failed'], 0)
+            self.assertNotIn('source', client.settings)
+
+    def test_verify(self):
+        for version, slice_field in [('5.1.1', None), ('2.3.0', 'ts')]:
+            client = FakeElasticsearch(version=version)
+            client.add('source', self.docs)
+            reindexer = Reindexer(client, workers=3, slice_field=slice_field)
+            reindexer.native = False
+            reindexer.do_reindex('source', 'target')
+            reports = reindexer.verify('source', 'target', sample_size=5)
+            self.assertEqual(len(reports), 3)
+            self.assertTrue(all(r['ok'] and r['sample'] for r in reports))
+            self.assertEqual(sum(r['target'] for r in reports), 101)
+
+            # A missing document and a changed one.
+            client.docs['target'].pop('50')
+            client.docs['target']['0']['_source'] = {'name': 'changed'}
+            reports = reindexer.verify('source', 'target', sample_size=5)
+            self.assertEqual(sorted((r['source'] - r['target'], r['sample']) for r in reports if not r['ok']),
+                             [(0, False), (1, True)])
+
+    def test_verify_shards_differ(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=3)
+        reindexer.native = False
+        reindexer.do_reindex('source', 'target')
+        client.shards['target'] = 2
+        reports = reindexer.verify('source', 'target', sample_size=5)
+        self.assertEqual([(r['source'], r['target'], r['ok']) for r in reports], [(101, 101, True)])
+
+    def test_verify_transformed(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs[:-1])
+        reindexer = Reindexer(client, workers=2)
+        reindexer.transforms = [Map(_rename_ts)]
+        reindexer.do_reindex('source', 'target')
+        self.assertTrue(all(r['ok'] and r['sample'] for r in reindexer.verify('source', 'target', sample_size=5)))
+
+    def test_verify_missing_target(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        reports = Reindexer(client).verify('source', 'target')
+        self.assertEqual(reports, [{'partition': 0, 'source': 101, 'target': 0, 'sample': None, 'ok': False}])
+
+    def test_native_rethrottle(self):
+        client = FakeElasticsearch(version='5.0.0')
+        client.add('source', self.docs)
+        reindexer = Reindexer(client, workers=4)
+        reindexer.poll_interval = 0
+        # Scaled by a signal while the task runs.
+        reindexer.client.transport.perform_request.side_effect = lambda method, url, **kwargs: (
+            reindexer.throttle.set_rate(docs_per_second=100), client._perform_request(method, url, **kwargs))[1]
+        reindexer.do_reindex('source', 'target')
+        self.assert_copied(client)
+        self.assertEqual(client.reindex_calls, [{'wait_for_completion': 'false'}, {'requests_per_second': 100}])
+
+    def test_native_cancel(self):
+        for cancel_fails in [False, True]:
+            client = FakeElasticsearch(version='5.1.1')
+            client.add('source', self.docs)
+            reindexer = Reindexer(client)
+
+            def perform_request(method, url, **kwargs):
+                if url.startswith('/_tasks/') and not url.endswith('_cancel'):
+                    raise TransportError(500, 'boom')
+                if url.endswith('_cancel') and cancel_fails:
+                    raise TransportError(500, 'boom')
+                return client._perform_request(method, url, **kwargs)
+            client.transport.perform_request.side_effect = perform_request
+
+            self.assertFalse(reindexer.do_reindex('source', 'target'))
+            if cancel_fails:
+                # The task may still be copying, so writes to the source stay blocked.
+                self.assertEqual(client.settings['source'], [{'index': {'blocks': {'write': True}}}])
+            else:
+                self.assertEqual(client.cancelled, ['node:0'])
+                self.assertEqual(client.settings['source'][-1], {'index': {'blocks': {'write': False}}})
+
+    def test_native_cancel_fails_dual_write(self):
+        client = FakeElasticsearch(version='5.1.1')
+        client.add('source', self.docs)
+        client.transport.perform_request.side_effect = lambda method, url, **kwargs: (
+            client._perform_request(method, url, **kwargs) if url == '/_reindex' else _raise(TransportError(500, 'boom')))
+        with mock.patch('pseudonym.reindexer.logger') as logger:
+            self.assertFalse(Reindexer(client).do_reindex('source', 'target', dual_write=True))
+        messages = [c[0][0] for c in logger.error.call_args_list]
+        self.assertIn('Reindex task node:0 may still be copying source, cancel it by hand.', messages)
+        self.assertFalse(any('write blocked' in m for m in messages))
+        self.assertNotIn('source', client.settings)
+
+    def test_native_fallback(self):
+        client = FakeElasticsearch(version='2.4.0')
+        reindexer = Reindexer(client)
+        self.assertFalse(reindexer.use_native())
+        reindexer._version = (5, 6)
+        self.assertFalse(reindexer.use_native(resume=True))
+
+    def test_resume(self):
+        client = FakeElasticsearch(version='2.3.0')
+        client.add('source', self.docs)
+        bulk = client.bulk
+
+        def failing_bulk(body, **kwargs):
+            if len(client.bulk_calls) == 3:
+                raise TransportError(500, 'boom')
+            return bulk(body)
+        client.bulk = failing_bulk
+
+        interval = ReindexCheckpoint.interval
+        ReindexCheckpoint.interval = 0
+        try:
+            reindexer = Reindexer(client, slice_field='ts', checkpoint_index='pseudonym')
+            reindexer.sizer = BatchSizer(docs=10, min_docs=10, max_docs=10)
+            reindexer.do_reindex('source', 'target')
+            self.assertEqual(len(client.docs['target']), 30)
+            checkpoint = ReindexCheckpoint.load(client, 'pseudonym', 'source', 'target')
+            self.assertEqual(checkpoint.partitions[0]['last'], 290)
+
+            client.bulk = bulk
+            client.bulk_calls = []
+            reindexer.do_reindex('source', 'target', resume=True)
+        finally:
+            ReindexCheckpoint.interval = interval
+        # Only the docs from the last key on, and those without one, are copied again.
+        self.assertEqual(sum(client.bulk_calls), 72)
+        self.assertEqual(sorted(d['_source']['name'] for d in client.docs['target'].values()),
+                         sorted(d['name'] for d in self.docs))
+        self.assertTrue(ReindexCheckpoint.load(client, 'pseudonym', 'source', 'target').completed)
+
+    def test_checkpoint_stops_at_failures(self):
+        for failing_call, last in [(2, 190), (10, 990)]:
+            client = FakeElasticsearch(version='2.3.0')
+            client.add('source', self.docs)
+            bulk = client.bulk
+
+            def failing_bulk(body, **kwargs):
+                if len(client.bulk_calls) == failing_call:
+                    client.bulk_calls.append(None)
+                    items = [json.loads(line) for line in body.split('\n') if line][::2]
+                    return {'errors': True, 'items': [{'index': {'_id': item['index']['_id'], 'status': 400}}
+                                                      for item in items]}
+                return bulk(body)
+            client.bulk = failing_bulk
+
+            interval = ReindexCheckpoint.interval
+            ReindexCheckpoint.interval = 0
+            try:
+                reindexer = Reindexer(client, slice_field='ts', checkpoint_index='pseudonym')
+                reindexer.sizer = BatchSizer(docs=10, min_docs=10, max_docs=10)
+                self.assertFalse(reindexer.do_reindex('source', 'target'))
+            finally:
+                ReindexCheckpoint.interval = interval
+            checkpoint = ReindexCheckpoint.load(client, 'pseudonym', 'source', 'target')
+            # Not past the failed chunk, nor back to the start for the docs without a key.
+            self.assertEqual(checkpoint.partitions[0]['last'], last)
+            self.assertFalse(checkpoint.completed)
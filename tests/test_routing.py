@@ -1,8 +1,10 @@
 import datetime
+import json
 import unittest
 
 from pseudonym.errors import RoutingException
-from pseudonym.strategy import Strategies
+from pseudonym import strategy
+from pseudonym.strategy import Strategies, RangeRouter
 
 
 class TestNoRouting(unittest.TestCase):
@@ -21,9 +23,73 @@ class TestDateStrategyRouting(unittest.TestCase):
         self.assertEqual(router.route(datetime.datetime(2014, 1, 1))['name'], '201401')
         self.assertEqual(router.route(datetime.datetime(2014, 2, 1))['name'], '201402')
 
+    def test_rejects_strings(self):
+        schema = {'aliases': [{'name': 'alias1', 'indexes': ['201401', '201402']}],
+                  'indexes': [{'name': '201401', 'routing': '2014-01-01T00:00:00'},
+                              {'name': '201402', 'routing': '2014-02-01T00:00:00'}]}
+        router = Strategies['date'].instance().get_router(schema, schema['aliases'][0])
+        self.assertRaises(RoutingException, router.route, '2014-01-15')
+        self.assertRaises(RoutingException, router.route_many, ['2014-01-15'])
+        self.assertEqual(router.route(1390000000)['name'], '201401')
+
+    def test_parsed_dates_bounded(self):
+        for day in range(strategy._MAX_PARSED_DATES + 10):
+            strategy.parse_date_routing((datetime.datetime(2000, 1, 1) + datetime.timedelta(days=day)).isoformat())
+        self.assertLessEqual(len(strategy._PARSED_DATES), strategy._MAX_PARSED_DATES)
+
+    def test_routes_to_dicts(self):
+        schema = {'aliases': [{'name': 'alias1', 'indexes': ['201401']}],
+                  'indexes': [{'name': '201401', 'alias': 'alias1', 'routing': '2014-01-01T00:00:00', 'owner': 'x'}]}
+        index = Strategies['date'].instance().get_router(schema, schema['aliases'][0]).route(datetime.date(2014, 2, 1))
+        self.assertEqual(dict(index), schema['indexes'][0])
+        self.assertEqual(json.loads(json.dumps(index)), schema['indexes'][0])
+
 
 class TestSingleIndexRoutingStrategy(unittest.TestCase):
     def test(self):
         schema = {'indexes': [{'name': 'test'}]}
         router = Strategies['single'].instance().get_router(schema, {'name': 'test'})
         self.assertEqual(router.route('who cares'), {'alias': 'test', 'name': 'test'})
+
+
+class TestRangeRouter(unittest.TestCase):
+    def test(self):
+        indexes = [{'name': str(i), 'routing': i * 10} for i in range(100, 0, -1)]
+        router = RangeRouter(indexes, {'name': 'alias1'})
+        self.assertEqual(router.route(5)['name'], '1')
+        self.assertEqual(router.route(10)['name'], '1')
+        self.assertEqual(router.route(15)['name'], '1')
+        self.assertEqual(router.route(20)['name'], '2')
+        self.assertEqual(router.route(999)['name'], '99')
+        self.assertEqual(router.route(5000)['name'], '100')
+
+    def test_matches_linear_scan(self):
+        indexes = [{'name': name, 'routing': routing} for name, routing in [('c', 3), ('b2', 2), ('b1', 2), ('a', 1)]]
+        router = RangeRouter(indexes, {'name': 'alias1'})
+        for routing in range(5):
+            expected = next((i for i in indexes if routing >= i['routing']), indexes[-1])
+            self.assertIs(router.route(routing), expected)
+
+    def test_no_indexes(self):
+        self.assertRaises(RoutingException, RangeRouter, [], {'name': 'alias1'})
+
+    def test_route_many(self):
+        indexes = [{'name': str(i), 'routing': i * 10} for i in range(5, 0, -1)]
+        router = RangeRouter(indexes, {'name': 'alias1'})
+        routings = [55, 3, 20, 10, 49, 19, 20, 100, 0]
+        groups = router.route_many(routings)
+        self.assertEqual(groups, {'1': [0, 3, 10, 19], '2': [20, 20], '4': [49], '5': [55, 100]})
+        for routing in routings:
+            self.assertIn(routing, groups[router.route(routing)['name']])
+
+        docs = [{'id': i, 'ts': routing} for i, routing in enumerate(routings)]
+        groups = router.route_many(docs, key=lambda doc: doc['ts'])
+        self.assertEqual({name: sorted(d['id'] for d in docs) for name, docs in groups.items()},
+                         {'1': [1, 3, 5, 8], '2': [2, 6], '4': [4], '5': [0, 7]})
+        self.assertEqual(router.route_many([]), {})
+
+
+class TestSingleIndexRouteMany(unittest.TestCase):
+    def test(self):
+        router = Strategies['single'].instance().get_router({}, {'name': 'test'})
+        self.assertEqual(router.route_many(['a', 'b']), {'test': ['a', 'b']})
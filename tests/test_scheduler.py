@@ -0,0 +1,101 @@
+import mock
+import threading
+import time
+import unittest
+
+from pseudonym.reindexer import Reindexer
+from pseudonym.scheduler import ReindexScheduler
+from tests.fake_es import FakeElasticsearch
+
+
+class TestReindexScheduler(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeElasticsearch()
+        self.shards = {'a': ['n1'], 'b': ['n1', 'n2'], 'c': ['n2'], 'd': ['n3']}
+        self.client.search_shards = lambda index: {
+            'shards': [[{'node': node, 'index': index}] for node in self.shards[index]]}
+        self.manager = mock.Mock()
+        self.manager.client = self.client
+        self.manager.schema_index = 'pseudonym'
+        self.manager.get_current_schema.return_value = ({}, {'aliases': [{'name': 'monthly', 'indexes': sorted(self.shards)}]})
+
+        self.lock = threading.Lock()
+        self.running = set()
+        self.overlaps = []
+        self.failing = set()
+
+        def reindex(index_name, resume=False, reindexer=None, **kwargs):
+            with self.lock:
+                self.overlaps.append((index_name, set(self.running)))
+                self.running.add(index_name)
+            time.sleep(0.05)
+            with self.lock:
+                self.running.remove(index_name)
+            return index_name not in self.failing
+        self.manager.reindex.side_effect = reindex
+        self.manager.reindex_cutover.return_value = True
+
+    def scheduler(self, **kwargs):
+        scheduler = ReindexScheduler(self.manager, 'monthly', **kwargs)
+        scheduler.poll_interval = 0.01
+        return scheduler
+
+    def test_concurrency(self):
+        states = self.scheduler(concurrency=2, per_node=1).run()
+        self.assertEqual(states, {name: 'done' for name in self.shards})
+        for index, overlap in self.overlaps:
+            self.assertLessEqual(len(overlap), 1)
+            # No two indexes on a shared node ran together.
+            for other in overlap:
+                self.assertFalse(set(self.shards[index]) & set(self.shards[other]))
+        self.assertEqual(sorted(c[0][0] for c in self.manager.reindex_cutover.call_args_list), sorted(self.shards))
+
+    def test_resume(self):
+        self.failing = {'b'}
+        states = self.scheduler().run()
+        self.assertEqual(states['b'], 'failed')
+        self.assertEqual(self.client.get(index='pseudonym', id='monthly')['_source']['indexes'], states)
+
+        self.failing = set()
+        self.manager.reindex.reset_mock()
+        states = self.scheduler().run(resume=True)
+        self.assertEqual(states, {name: 'done' for name in self.shards})
+        self.assertEqual([c[0][0] for c in self.manager.reindex.call_args_list], ['b'])
+        self.assertTrue(self.manager.reindex.call_args[1]['resume'])
+
+    def test_reindex_options(self):
+        states = self.scheduler(sample_size=5, sleep_time=0.5, force_merge=1, dual_write=True).run()
+        self.assertEqual(states, {name: 'done' for name in self.shards})
+        for call in self.manager.reindex.call_args_list:
+            self.assertEqual((call[1]['sleep_time'], call[1]['force_merge'], call[1]['online'], call[1]['dual_write'],
+                              call[1]['sample_size']), (0.5, 1, False, True, 5))
+        self.assertEqual(sorted(c[0] for c in self.manager.reindex_cutover.call_args_list),
+                         [(name, 5) for name in sorted(self.shards)])
+
+    def test_online_cuts_over_in_reindex(self):
+        states = self.scheduler(online=True).run()
+        self.assertEqual(states, {name: 'done' for name in self.shards})
+        self.assertTrue(all(c[1]['online'] for c in self.manager.reindex.call_args_list))
+        self.assertFalse(self.manager.reindex_cutover.called)
+
+    def test_interrupt(self):
+        self.manager.reindexer.clone.side_effect = lambda: Reindexer(self.client)
+        cleaned_up = []
+
+        def reindex(index_name, resume=False, reindexer=None, **kwargs):
+            try:
+                while not reindexer.stopped:
+                    time.sleep(0.01)
+                return False
+            finally:
+                cleaned_up.append(index_name)
+        self.manager.reindex.side_effect = reindex
+
+        scheduler = self.scheduler(concurrency=2)
+        with mock.patch('pseudonym.scheduler.time') as scheduler_time:
+            scheduler_time.sleep.side_effect = KeyboardInterrupt
+            self.assertRaises(KeyboardInterrupt, scheduler.run)
+        # Both running reindexes were stopped and finished before run gave up.
+        self.assertEqual(sorted(cleaned_up), ['a', 'c'])
+        self.assertEqual(scheduler.states, {'a': 'failed', 'b': 'pending', 'c': 'failed', 'd': 'pending'})
+        self.assertFalse(self.manager.reindex_cutover.called)
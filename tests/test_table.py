@@ -0,0 +1,53 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from pseudonym.errors import RoutingException
+from pseudonym.snapshot import SchemaSnapshot
+from pseudonym.table import RoutingTable
+
+
+class TestRoutingTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'routing.json')
+        schema = {'aliases': [{'name': 'dated', 'strategy': {'date': {}}, 'indexes': ['201401', '201402']},
+                              {'name': 'pointer', 'strategy': {'alias_pointer': {'aliases': ['dated']}}, 'indexes': ['201401', '201402']},
+                              {'name': 'latest', 'strategy': {'latest_index': {'aliases': ['dated']}}, 'indexes': ['201402']},
+                              {'name': 'unroutable', 'strategy': {'index_pointer': {'indexes': ['201401']}}, 'indexes': ['201401']}],
+                  'indexes': [{'name': '201401', 'alias': 'dated', 'routing': '2014-01-01T00:00:00'},
+                              {'name': '201402', 'alias': 'dated', 'routing': '2014-02-01T00:00:00'}]}
+        self.snapshot = SchemaSnapshot({'_version': 3}, schema)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        RoutingTable.from_snapshot(self.snapshot).dump(self.path)
+        table = RoutingTable.load(self.path)
+        self.assertEqual(table.version, 3)
+
+        for alias, routing in [('dated', datetime.datetime(2013, 1, 1)),
+                               ('dated', datetime.datetime(2014, 1, 31)),
+                               ('dated', datetime.date(2014, 2, 1)),
+                               ('pointer', '2014-01-15T00:00:00'),
+                               ('pointer', '2015-01-01T00:00:00'),
+                               ('latest', None)]:
+            self.assertEqual(table.route(alias, routing), self.snapshot.get_router(alias).route(routing)['name'])
+
+        self.assertEqual(table.route_many('dated', [datetime.datetime(2014, 1, 2), datetime.datetime(2014, 3, 1)]),
+                         {'201401': [datetime.datetime(2014, 1, 2)], '201402': [datetime.datetime(2014, 3, 1)]})
+        self.assertRaises(RoutingException, table.route, 'unroutable', None)
+
+    def test_migrations(self):
+        self.snapshot.schema['migrations'] = {'201401': '201401-a'}
+        snapshot = SchemaSnapshot({'_version': 4}, self.snapshot.schema, self.snapshot)
+        RoutingTable.from_snapshot(snapshot).dump(self.path)
+        table = RoutingTable.load(self.path)
+        self.assertEqual(table.route_writes('dated', datetime.datetime(2014, 1, 2)), ['201401', '201401-a'])
+        self.assertEqual(table.route_writes('dated', datetime.datetime(2014, 2, 2)), ['201402'])
+        self.assertEqual(table.route_many_writes('dated', [datetime.datetime(2014, 1, 2), datetime.datetime(2014, 3, 1)]),
+                         {'201401': [datetime.datetime(2014, 1, 2)], '201401-a': [datetime.datetime(2014, 1, 2)],
+                          '201402': [datetime.datetime(2014, 3, 1)]})
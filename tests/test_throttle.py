@@ -0,0 +1,41 @@
+import threading
+import time
+import unittest
+
+from pseudonym.throttle import Throttle
+
+
+class TestThrottle(unittest.TestCase):
+    def test_docs_per_second(self):
+        throttle = Throttle(docs_per_second=1000)
+        start = time.time()
+        for _ in range(1500):
+            throttle.wait(1)
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+    def test_bytes_per_second_across_threads(self):
+        throttle = Throttle(bytes_per_second=10000)
+
+        def send():
+            for _ in range(5):
+                throttle.wait(1, 1000)
+        threads = [threading.Thread(target=send) for _ in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+    def test_set_rate(self):
+        throttle = Throttle()
+        self.assertFalse(throttle.enabled)
+        throttle.set_rate(docs_per_second=10)
+        throttle.scale(100)
+        self.assertEqual(throttle.docs_per_second, 1000)
+        self.assertIsNone(throttle.bytes_per_second)
+        throttle.set_rate()
+        start = time.time()
+        for _ in range(10000):
+            throttle.wait(1)
+        self.assertLess(time.time() - start, 0.5)
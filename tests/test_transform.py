@@ -0,0 +1,73 @@
+import unittest
+from multiprocessing import Pool
+
+from pseudonym.transform import Filter, Map, Split, pipeline, load_stages
+
+
+def _even(hit):
+    return hit['_source']['n'] % 2 == 0
+
+
+def _rename(hit):
+    hit['_source']['value'] = hit['_source'].pop('n')
+    return hit
+
+
+def _twice(hit):
+    return [hit, dict(hit, _id=hit['_id'] + '-copy')]
+
+
+STAGES = [Filter(_even), Map(_rename, in_pool=True)]
+
+
+def _hits(count):
+    return [{'_id': str(i), '_source': {'n': i}} for i in range(count)]
+
+
+class TestPipeline(unittest.TestCase):
+    def test_stages(self):
+        hits = pipeline(_hits(5), [Filter(_even), Map(_rename), Split(_twice)])
+        self.assertEqual([(h['_id'], h['_source']) for h in hits],
+                         [('0', {'value': 0}), ('0-copy', {'value': 0}), ('2', {'value': 2}),
+                          ('2-copy', {'value': 2}), ('4', {'value': 4}), ('4-copy', {'value': 4})])
+
+    def test_map_drops_none(self):
+        hits = pipeline(_hits(3), [Map(lambda hit: hit if hit['_id'] != '1' else None)])
+        self.assertEqual([h['_id'] for h in hits], ['0', '2'])
+
+    def test_lazy(self):
+        consumed = []
+
+        def source():
+            for hit in _hits(1000):
+                consumed.append(hit)
+                yield hit
+        hits = pipeline(source(), [Map(_rename)])
+        next(hits)
+        self.assertEqual(len(consumed), 1)
+
+    def test_pool(self):
+        pool = Pool(2)
+        try:
+            consumed = []
+
+            def source():
+                for hit in _hits(1000):
+                    consumed.append(hit)
+                    yield hit
+            hits = pipeline(source(), [Map(_rename, in_pool=True), Split(_twice, in_pool=True)], pool,
+                            batch_size=10, window=2)
+            self.assertEqual(next(hits)['_source'], {'value': 0})
+            # Only a window's worth of batches is read ahead.
+            self.assertLessEqual(len(consumed), 40)
+            self.assertEqual([h['_source']['value'] for h in hits][-1], 999)
+        finally:
+            pool.terminate()
+
+    def test_load_stages(self):
+        self.assertEqual(load_stages('tests.test_transform:STAGES'), STAGES)
+        self.assertEqual(len(load_stages('tests.test_transform:_stages')), 1)
+
+
+def _stages():
+    return Map(_rename)